@@ -1,8 +1,24 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime
 import matplotlib.pyplot as plt
 import io
+import hashlib
+import math
+import json
+import os
+import re
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from openpyxl import Workbook
+import pyarrow as pa
 # Configuración de la página
 st.set_page_config(
     page_title="Tasa Recompra TLL",
@@ -16,24 +32,658 @@ st.set_page_config(
 GOOGLE_DRIVE_FILE_ID = "1CCKbRsijh7qls7-tUWgVoeHhlGHTrflY"
 # ============================================
 
+# Trabajos en segundo plano: máximo de hilos compartidos por todas las sesiones
+MAX_TRABAJOS_SIMULTANEOS = 2
+# Exportaciones en segundo plano: hilos propios, para no ocupar los de los análisis
+MAX_EXPORTACIONES_SIMULTANEAS = 2
+# Filas que se escriben por bloque en las exportaciones (acota la memoria usada)
+FILAS_POR_BLOQUE = 5000
+# Carpetas de exportación abandonadas (sesión cerrada sin descargar) se borran tras este tiempo
+VIGENCIA_EXPORTACIONES = 2 * 3600  # segundos
+
+@st.cache_resource
+def obtener_ejecutor():
+    """Pool acotado de hilos, compartido por todas las sesiones, para trabajos en segundo plano"""
+    return ThreadPoolExecutor(max_workers=MAX_TRABAJOS_SIMULTANEOS, thread_name_prefix='tll')
+
+@st.cache_resource
+def obtener_ejecutor_exportaciones():
+    """Pool aparte para las exportaciones: una exportación larga no frena los análisis de nadie"""
+    return ThreadPoolExecutor(max_workers=MAX_EXPORTACIONES_SIMULTANEAS, thread_name_prefix='tll_exportacion')
+
+def años_de_referencia():
+    """Años que ofrece el selector de año de referencia (el actual y los 5 anteriores)"""
+    return list(range(datetime.now().year, datetime.now().year - 6, -1))
+
+# Almacén persistente de resultados: ruta del archivo SQLite y tamaño máximo.
+# Por defecto vive en una carpeta privada del usuario que ejecuta el aplicativo (no en
+# el temporal compartido): guarda datos de contacto de clientes
+RUTA_ALMACEN = os.environ.get(
+    'TLL_ALMACEN_RESULTADOS',
+    os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+        'tllrecompra', 'resultados.sqlite'
+    )
+)
+TAMAÑO_MAXIMO_ALMACEN = 512 * 1024 * 1024  # 512 MB
+# Cambiar al modificar el formato de los resultados, para no leer entradas viejas
+VERSION_RESULTADOS = 4
+
+# Modo aproximado: precisión de los bocetos HyperLogLog (2^12 registros por boceto)
+PRECISION_HLL = 12
+# Un boceto con más registros ocupados que este umbral se guarda denso (2^PRECISION_HLL bytes);
+# con menos, como pares (registro, valor) a 7 bytes por par
+UMBRAL_BOCETO_DENSO = (1 << PRECISION_HLL) // 8
+
 # Función para cargar datos desde Google Drive
-@st.cache_data(ttl=3600)  # Cache por 1 hora
+@st.cache_resource(ttl=3600)  # Cache por 1 hora
 def cargar_datos_desde_drive(file_id):
-    """Carga el CSV desde Google Drive y convierte las fechas correctamente"""
-    url = f'https://drive.google.com/uc?id={file_id}'
+    """
+    Carga el CSV desde Google Drive y convierte las fechas correctamente.
+    El DataFrame se comparte entre sesiones sin copiarlo: se trata como de solo lectura
+    (los análisis lo recorren con aplicar_filtros y nunca lo modifican).
+    Si está definida la variable TLL_DATOS_LOCAL, lee ese archivo local en su lugar
+    (lo usa la prueba de carga, prueba_carga.py).
+    """
+    url = os.environ.get('TLL_DATOS_LOCAL') or f'https://drive.google.com/uc?id={file_id}'
     try:
         df = pd.read_csv(url)
         # Convertir la columna de fecha AQUÍ, una sola vez, en formato DD/MM/YYYY
         columna_fecha = df.columns[2]  # Columna C [2]
         df[columna_fecha] = pd.to_datetime(df[columna_fecha], format='%d/%m/%Y', errors='coerce')
+        # Huella del contenido: identifica el conjunto de datos en las claves de los trabajos
+        df.attrs['huella'] = hashlib.sha256(
+            pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()
+        ).hexdigest()
         return df, None
     except Exception as e:
         return None, str(e)
 
+def construir_indice_busqueda(df_clientes):
+    """
+    Precalcula, una sola vez por análisis, un texto en minúsculas por cliente con
+    código, nombre y placas (si el listado las tiene), para que la búsqueda no recorra
+    varias columnas en cada rerun.
+    """
+    indice = df_clientes['Código Cliente'].astype(str) + ' ' + df_clientes['Nombre'].fillna('').astype(str)
+    if 'Placas' in df_clientes.columns:
+        indice = indice + ' ' + df_clientes['Placas'].fillna('').astype(str)
+    return indice.str.lower()
+
+@st.fragment
+def tabla_paginada(df_tabla, indice_busqueda, key, etiqueta_busqueda="🔎 Buscar por nombre, código o placa:"):
+    """
+    Muestra una tabla paginada del lado del servidor.
+    La búsqueda, el ordenamiento y el corte de la página se hacen en pandas,
+    y solo las filas de la página visible se envían al navegador.
+    Es un fragmento: buscar o cambiar de página no vuelve a ejecutar la sección que la contiene.
+    """
+    col1, col2, col3, col4 = st.columns([3, 2, 1, 1])
+    with col1:
+        texto_busqueda = st.text_input(
+            etiqueta_busqueda,
+            key=f'{key}_busqueda'
+        )
+    with col2:
+        columna_orden = st.selectbox(
+            "Ordenar por:",
+            list(df_tabla.columns),
+            key=f'{key}_orden'
+        )
+    with col3:
+        sentido_orden = st.selectbox(
+            "Sentido:",
+            ['Ascendente', 'Descendente'],
+            key=f'{key}_sentido'
+        )
+    with col4:
+        filas_por_pagina = st.selectbox(
+            "Filas por página:",
+            [25, 50, 100, 200],
+            index=1,
+            key=f'{key}_filas'
+        )
+
+    # Búsqueda sobre el índice precalculado
+    df_resultado = df_tabla
+    texto = texto_busqueda.strip().lower()
+    if texto:
+        coincide = indice_busqueda.loc[df_resultado.index].str.contains(texto, regex=False)
+        df_resultado = df_resultado[coincide.to_numpy()]
+
+    total_filas = len(df_resultado)
+    if total_filas == 0:
+        st.warning("⚠️ Ningún cliente coincide con la búsqueda.")
+        return
+
+    # Ordenar (los códigos pueden venir mezclados entre números y texto)
+    df_resultado = df_resultado.sort_values(
+        columna_orden,
+        ascending=(sentido_orden == 'Ascendente'),
+        kind='stable',
+        key=lambda serie: serie.astype(str) if serie.dtype == object else serie
+    )
+
+    total_paginas = max(1, math.ceil(total_filas / filas_por_pagina))
+    pagina = st.number_input(
+        f"Página (de {total_paginas}):",
+        min_value=1,
+        max_value=total_paginas,
+        value=1,
+        step=1,
+        key=f'{key}_pagina'
+    )
+
+    inicio = (int(pagina) - 1) * filas_por_pagina
+    fin = min(inicio + filas_por_pagina, total_filas)
+    st.dataframe(df_resultado.iloc[inicio:fin], use_container_width=True)
+    st.caption(f"Mostrando filas {inicio + 1}–{fin} de {total_filas}")
+
+def nombre_archivo_seguro(valor):
+    """Convierte un valor de CDS o familia en un nombre de archivo válido"""
+    return re.sub(r'[^\w\-]+', '_', str(valor)).strip('_') or 'Sin_dato'
+
+def nombre_unico(nombre, usados):
+    """Agrega un sufijo numérico si el nombre ya se usó (dos valores distintos pueden dar el mismo nombre seguro)"""
+    candidato = nombre
+    numero = 2
+    while candidato in usados:
+        candidato = f'{nombre}_{numero}'
+        numero += 1
+    usados.add(candidato)
+    return candidato
+
+def barrer_exportaciones_vencidas():
+    """Borra carpetas de exportación de más de VIGENCIA_EXPORTACIONES sin cambios (de sesiones ya cerradas)"""
+    limite = time.time() - VIGENCIA_EXPORTACIONES
+    raiz = tempfile.gettempdir()
+    for nombre in os.listdir(raiz):
+        ruta = os.path.join(raiz, nombre)
+        try:
+            if nombre.startswith('tll_exportacion_') and os.path.getmtime(ruta) < limite:
+                shutil.rmtree(ruta, ignore_errors=True)
+        except OSError:
+            pass
+
+def descartar_exportacion():
+    """
+    Quita la exportación por partición de la sesión y borra sus archivos. Si todavía está
+    en curso, la marca para que el hilo que la genera borre la carpeta al terminar.
+    """
+    exportacion = st.session_state.pop('exportacion_particiones', None)
+    if exportacion is None:
+        return
+    exportacion['descartada'] = True
+    if exportacion['estado'] != 'en_curso' and exportacion.get('carpeta'):
+        shutil.rmtree(exportacion['carpeta'], ignore_errors=True)
+
+def leer_y_borrar_exportacion(exportacion):
+    """
+    Contenido del ZIP para el botón de descarga, leído solo cuando se pulsa. Una vez
+    entregado se borra la carpeta temporal: los datos de contacto no quedan en disco.
+    """
+    def leer():
+        with open(exportacion['archivo'], 'rb') as archivo:
+            datos = archivo.read()
+        shutil.rmtree(exportacion['carpeta'], ignore_errors=True)
+        exportacion['estado'] = 'descargado'
+        return datos
+    return leer
+
+def exportar_particiones(df_perdidos, particiones_perdidos, columna_id, columna_departamento,
+                         columna_familia, año_actual, progreso):
+    """
+    Exportación en segundo plano del listado de clientes perdidos, partido por CDS y familia.
+    En un solo recorrido agrupado escribe un CSV y un Excel por partición, por bloques de
+    FILAS_POR_BLOQUE filas, y los va agregando a un único ZIP. El avance se reporta en el
+    diccionario `progreso`, que la interfaz consulta sin bloquearse.
+    """
+    carpeta = tempfile.mkdtemp(prefix='tll_exportacion_')
+    progreso['carpeta'] = carpeta
+    try:
+        # Combinaciones únicas cliente / CDS / familia de los clientes a exportar
+        pares = particiones_perdidos[particiones_perdidos[columna_id].isin(df_perdidos['Código Cliente'])].copy()
+        pares[[columna_departamento, columna_familia]] = pares[[columna_departamento, columna_familia]].fillna('Sin dato')
+
+        perdidos_por_codigo = df_perdidos.set_index('Código Cliente', drop=False)
+        grupos = pares.groupby([columna_departamento, columna_familia], sort=True)[columna_id]
+        total_grupos = grupos.ngroups
+
+        # Nombres de carpeta por CDS y de archivo por partición, sin repetidos dentro del ZIP
+        carpetas_cds = {}
+        usados_cds = set()
+        usados_bases = set()
+
+        ruta_zip = os.path.join(carpeta, f'clientes_no_regresaron_{año_actual}_por_cds_familia.zip')
+        with zipfile.ZipFile(ruta_zip, 'w', compression=zipfile.ZIP_DEFLATED) as archivo_zip:
+            for numero, ((cds, familia), codigos) in enumerate(grupos, start=1):
+                progreso['mensaje'] = f"Exportando {cds} / {familia} ({numero} de {total_grupos})"
+                if cds not in carpetas_cds:
+                    carpetas_cds[cds] = nombre_unico(nombre_archivo_seguro(cds), usados_cds)
+                nombre_base = nombre_unico(
+                    f"{nombre_archivo_seguro(cds)}__{nombre_archivo_seguro(familia)}", usados_bases
+                )
+                ruta_csv = os.path.join(carpeta, f'{nombre_base}.csv')
+                ruta_xlsx = os.path.join(carpeta, f'{nombre_base}.xlsx')
+
+                # Excel en modo solo escritura: las filas no se guardan en memoria
+                libro = Workbook(write_only=True)
+                hoja = libro.create_sheet('Clientes No Regresaron')
+                hoja.append(list(df_perdidos.columns))
+
+                codigos = codigos.to_numpy()
+                for inicio in range(0, len(codigos), FILAS_POR_BLOQUE):
+                    bloque = perdidos_por_codigo.loc[codigos[inicio:inicio + FILAS_POR_BLOQUE]]
+                    bloque.to_csv(
+                        ruta_csv,
+                        index=False,
+                        mode='w' if inicio == 0 else 'a',
+                        header=(inicio == 0),
+                        encoding='utf-8-sig' if inicio == 0 else 'utf-8'
+                    )
+                    for fila in bloque.astype(object).where(bloque.notna(), None).itertuples(index=False):
+                        hoja.append(list(fila))
+                libro.save(ruta_xlsx)
+
+                # Agregar al ZIP y borrar los archivos sueltos para no acumular disco
+                for ruta in (ruta_csv, ruta_xlsx):
+                    archivo_zip.write(ruta, arcname=f'{carpetas_cds[cds]}/{os.path.basename(ruta)}')
+                    os.remove(ruta)
+
+                progreso['progreso'] = numero / total_grupos
+
+        progreso['archivo'] = ruta_zip
+        progreso['particiones'] = total_grupos
+        progreso['mensaje'] = f"Exportación lista: {total_grupos} particiones"
+        progreso['progreso'] = 1.0
+        progreso['estado'] = 'terminado'
+    except Exception as e:
+        progreso['mensaje'] = str(e)
+        progreso['estado'] = 'error'
+        shutil.rmtree(carpeta, ignore_errors=True)
+    finally:
+        # La sesión cambió de análisis mientras se exportaba: nadie va a descargar este ZIP
+        if progreso.get('descartada'):
+            shutil.rmtree(carpeta, ignore_errors=True)
+
+@st.fragment(run_every=2)
+def seguimiento_exportacion():
+    """Consulta el avance de la exportación por particiones sin volver a ejecutar toda la página"""
+    progreso = st.session_state['exportacion_particiones']
+    st.progress(progreso['progreso'], text=progreso['mensaje'])
+    if progreso['estado'] != 'en_curso':
+        # Una sola ejecución completa para mostrar el resultado final fuera del fragmento
+        st.rerun()
+
+# Filtros de dimensión: (clave del widget, posición de la columna, título, etiqueta)
+FILTROS_DIMENSION = [
+    ('asesor', 11, "👤 Asesor", "Selecciona tipo(s) de asesor:"),  # Columna L
+    ('depto', 13, "🏢 CDS", "Selecciona departamento(s):"),  # Columna N
+    ('familia', 18, "🛞 Producto", "Selecciona familia(s):"),  # Columna S
+    ('area', 22, "📍 Área", "Selecciona área(s):"),  # Columna W
+]
+
+@st.cache_data(max_entries=32)
+def opciones_filtro(_df, huella, columna):
+    """Opciones de un filtro de dimensión, calculadas una vez por conjunto de datos"""
+    return ['Todos'] + sorted(_df[columna].dropna().unique().tolist())
+
+def seccion_filtros(df, sufijo=''):
+    """
+    Muestra los filtros de asesor, CDS, producto y área.
+    Devuelve las selecciones activas como tupla de (columna, valores), que sirve
+    también como parte de la clave de un trabajo.
+    """
+    filtros = []
+    for col, (clave, posicion, titulo, etiqueta) in zip(st.columns(4), FILTROS_DIMENSION):
+        columna = df.columns[posicion]
+        with col:
+            st.subheader(titulo)
+            valores = opciones_filtro(df, df.attrs.get('huella'), columna)
+            seleccion = st.multiselect(
+                etiqueta,
+                valores,
+                default=['Todos'],
+                key=f'{clave}{sufijo}'
+            )
+        if 'Todos' not in seleccion:
+            # Ordenadas: la misma selección da la misma clave sin importar el orden de los clics
+            filtros.append((columna, tuple(sorted(seleccion))))
+    return tuple(filtros)
+
+def filas_filtradas(df, filtros, años=None, sin_vacios=()):
+    """
+    Posiciones de las filas que cumplen todas las selecciones de seccion_filtros, caen en
+    alguno de los años indicados y no tienen vacías las columnas de sin_vacios, junto con
+    el año de cada una. Todas las condiciones se combinan en una sola máscara booleana.
+    """
+    mascara = np.ones(len(df), dtype=bool)
+    for columna, valores in filtros:
+        mascara &= df[columna].isin(valores).to_numpy()
+    for columna in sin_vacios:
+        mascara &= df[columna].notna().to_numpy()
+    año_por_fila = df[df.columns[2]].dt.year.to_numpy()
+    if años is not None:
+        mascara &= np.isin(año_por_fila, list(años))
+    posiciones = np.flatnonzero(mascara)
+    return posiciones, año_por_fila[posiciones]
+
+def aplicar_filtros(df, filtros, columnas, años=None, sin_vacios=()):
+    """
+    Aplica las selecciones de seccion_filtros sobre el DataFrame compartido, que no se
+    copia ni se modifica: solo se toman las filas seleccionadas y las columnas indicadas
+    (por posición), más la columna 'Año'. La memoria de cada análisis crece con el
+    resultado y no con el conjunto de datos completo.
+    """
+    posiciones, años_filas = filas_filtradas(df, filtros, años, sin_vacios)
+    df_filtrado = df.iloc[posiciones, list(columnas)]
+    df_filtrado.insert(len(df_filtrado.columns), 'Año', años_filas)
+    return df_filtrado
+
+class AlmacenResultados:
+    """
+    Almacén de resultados en SQLite que sobrevive a reinicios y se comparte entre
+    procesos. Cada resultado se guarda serializado bajo una clave derivada de la
+    huella de los datos y de los parámetros. Al superar el tamaño máximo se borran
+    los resultados usados hace más tiempo.
+    """
+    def __init__(self, ruta, tamaño_maximo):
+        self.ruta = ruta
+        self.tamaño_maximo = tamaño_maximo
+        preparar_archivo_privado(ruta)
+        conexion = self._conectar()
+        try:
+            conexion.execute(
+                "CREATE TABLE IF NOT EXISTS resultados ("
+                "clave TEXT PRIMARY KEY, valor BLOB NOT NULL, "
+                "tamaño INTEGER NOT NULL, ultimo_uso REAL NOT NULL)"
+            )
+            conexion.execute("CREATE INDEX IF NOT EXISTS idx_ultimo_uso ON resultados (ultimo_uso)")
+        finally:
+            conexion.close()
+
+    def _conectar(self):
+        # Una conexión por operación (segura entre hilos y procesos), en modo autocommit:
+        # las transacciones de escritura se abren explícitamente
+        conexion = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+        conexion.execute("PRAGMA journal_mode=WAL")
+        return conexion
+
+    @staticmethod
+    def clave(partes):
+        """Clave estable a partir de la versión de los resultados y los parámetros del trabajo"""
+        return hashlib.sha256(repr((VERSION_RESULTADOS,) + tuple(partes)).encode('utf-8')).hexdigest()
+
+    def obtener(self, clave):
+        """Devuelve el resultado guardado o None"""
+        conexion = self._conectar()
+        try:
+            fila = conexion.execute("SELECT valor FROM resultados WHERE clave = ?", (clave,)).fetchone()
+            if fila is None:
+                return None
+            conexion.execute("UPDATE resultados SET ultimo_uso = ? WHERE clave = ?", (time.time(), clave))
+        finally:
+            conexion.close()
+        return deserializar_resultado(fila[0])
+
+    def guardar(self, clave, valor):
+        """Guarda un resultado y libera espacio si el almacén supera su tamaño máximo"""
+        datos = serializar_resultado(valor)
+        if len(datos) > self.tamaño_maximo:
+            return
+        conexion = self._conectar()
+        try:
+            # BEGIN IMMEDIATE serializa a los escritores de todos los procesos
+            conexion.execute("BEGIN IMMEDIATE")
+            conexion.execute(
+                "INSERT OR REPLACE INTO resultados (clave, valor, tamaño, ultimo_uso) VALUES (?, ?, ?, ?)",
+                (clave, sqlite3.Binary(datos), len(datos), time.time())
+            )
+            total = conexion.execute("SELECT COALESCE(SUM(tamaño), 0) FROM resultados").fetchone()[0]
+            if total > self.tamaño_maximo:
+                for clave_vieja, tamaño in conexion.execute(
+                    "SELECT clave, tamaño FROM resultados WHERE clave != ? ORDER BY ultimo_uso", (clave,)
+                ).fetchall():
+                    conexion.execute("DELETE FROM resultados WHERE clave = ?", (clave_vieja,))
+                    total -= tamaño
+                    if total <= self.tamaño_maximo:
+                        break
+            conexion.execute("COMMIT")
+        except Exception:
+            conexion.execute("ROLLBACK")
+            raise
+        finally:
+            conexion.close()
+
+def preparar_archivo_privado(ruta):
+    """
+    Crea la carpeta del almacén (0700) y el archivo (0600) si no existen, y se niega a
+    usar un archivo de otro usuario o que otros usuarios puedan leer o escribir.
+    SQLite crea sus archivos auxiliares (-wal, -shm) con los mismos permisos.
+    """
+    carpeta = os.path.dirname(os.path.abspath(ruta))
+    os.makedirs(carpeta, mode=0o700, exist_ok=True)
+    banderas = os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0)
+    os.close(os.open(ruta, banderas, 0o600))
+    if hasattr(os, 'getuid'):
+        estado = os.stat(ruta)
+        if estado.st_uid != os.getuid() or estado.st_mode & 0o077:
+            raise PermissionError(f"{ruta} no es un archivo privado de este usuario")
+        # Una carpeta en la que otros pueden escribir (sin sticky bit) permitiría reemplazarlo
+        estado = os.stat(carpeta)
+        if estado.st_mode & 0o022 and not estado.st_mode & 0o1000:
+            raise PermissionError(f"Otros usuarios pueden escribir en {carpeta}")
+
+def serializar_resultado(valor):
+    """
+    Convierte un resultado en bytes sin pickle: la estructura (diccionarios, listas,
+    conjuntos, números, textos y fechas) va en JSON y cada DataFrame o Series en
+    formato Arrow IPC, a continuación del JSON. Lanza TypeError con tipos no previstos.
+    """
+    tablas = []
+
+    def codificar(v):
+        if isinstance(v, np.generic):
+            v = v.item()
+        if v is None or isinstance(v, (bool, int, float, str)):
+            return v
+        if isinstance(v, dict):
+            return {'t': 'dict', 'k': [codificar(k) for k in v], 'v': [codificar(x) for x in v.values()]}
+        if isinstance(v, (list, tuple, set, frozenset)):
+            tipo = 'list' if isinstance(v, list) else 'tuple' if isinstance(v, tuple) else 'set'
+            return {'t': tipo, 'v': [codificar(x) for x in v]}
+        if isinstance(v, pd.Timestamp) or isinstance(v, datetime):
+            return {'t': 'ts', 'v': None if pd.isna(v) else pd.Timestamp(v).isoformat()}
+        if isinstance(v, (pd.DataFrame, pd.Series)):
+            es_serie = isinstance(v, pd.Series)
+            tabla = pa.Table.from_pandas(v.to_frame('valor') if es_serie else v, preserve_index=True)
+            salida = pa.BufferOutputStream()
+            with pa.ipc.new_stream(salida, tabla.schema) as escritor:
+                escritor.write_table(tabla)
+            tablas.append(salida.getvalue().to_pybytes())
+            return {'t': 'series' if es_serie else 'df', 'i': len(tablas) - 1,
+                    'nombre': codificar(v.name) if es_serie else None}
+        raise TypeError(f"Tipo no serializable en el almacén: {type(v).__name__}")
+
+    encabezado = json.dumps(codificar(valor)).encode('utf-8')
+    partes = [b'TLL2', struct.pack('<Q', len(encabezado)), encabezado]
+    for datos in tablas:
+        partes += [struct.pack('<Q', len(datos)), datos]
+    return b''.join(partes)
+
+def deserializar_resultado(datos):
+    """Inverso de serializar_resultado"""
+    if datos[:4] != b'TLL2':
+        raise ValueError("Formato de resultado desconocido")
+    largo = struct.unpack_from('<Q', datos, 4)[0]
+    estructura = json.loads(datos[12:12 + largo].decode('utf-8'))
+    tablas = []
+    posicion = 12 + largo
+    while posicion < len(datos):
+        largo = struct.unpack_from('<Q', datos, posicion)[0]
+        tablas.append(datos[posicion + 8:posicion + 8 + largo])
+        posicion += 8 + largo
+
+    def decodificar(v):
+        if not isinstance(v, dict):
+            return v
+        tipo = v['t']
+        if tipo == 'dict':
+            return {decodificar(k): decodificar(x) for k, x in zip(v['k'], v['v'])}
+        if tipo in ('list', 'tuple', 'set'):
+            elementos = [decodificar(x) for x in v['v']]
+            return elementos if tipo == 'list' else tuple(elementos) if tipo == 'tuple' else set(elementos)
+        if tipo == 'ts':
+            return pd.NaT if v['v'] is None else pd.Timestamp(v['v'])
+        tabla = pa.ipc.open_stream(tablas[v['i']]).read_all().to_pandas()
+        if tipo == 'series':
+            return tabla['valor'].rename(decodificar(v['nombre']))
+        return tabla
+
+    return decodificar(estructura)
+
+@st.cache_resource
+def obtener_almacen():
+    """
+    Almacén persistente de resultados de este proceso (el archivo se comparte entre procesos).
+    Si no se puede usar un archivo privado, los análisis se calculan sin almacén.
+    """
+    try:
+        return AlmacenResultados(RUTA_ALMACEN, TAMAÑO_MAXIMO_ALMACEN)
+    except Exception:
+        return None
+
+def ejecutar_trabajo(almacen, funcion, argumentos, trabajo):
+    """
+    Cuerpo de un trabajo en el pool: busca primero el resultado en el almacén persistente
+    y, si no está, lo calcula y lo guarda. Las claves de trabajo tienen la forma
+    (tipo, huella de los datos, parámetros...); sin huella o sin almacén no se usa.
+    """
+    if trabajo.clave[1] is None or almacen is None:
+        return funcion(*argumentos, trabajo)
+
+    clave = AlmacenResultados.clave(trabajo.clave)
+    trabajo.avanzar('Buscando resultados guardados...', 0.05)
+    try:
+        resultado = almacen.obtener(clave)
+    except Exception:
+        # Un almacén dañado o bloqueado no debe impedir el análisis
+        resultado = None
+    if resultado is not None:
+        return resultado
+
+    resultado = funcion(*argumentos, trabajo)
+    try:
+        almacen.guardar(clave, resultado)
+    except Exception:
+        pass
+    return resultado
+
+class Trabajo:
+    """
+    Análisis en segundo plano: guarda su clave (parámetros), la etapa y el avance,
+    cuántas sesiones lo esperan y una señal de cancelación que se revisa entre etapas.
+    """
+    def __init__(self, clave):
+        self.clave = clave
+        self.etapa = 'En cola...'
+        self.progreso = 0.0
+        self.suscriptores = 0
+        self.cancelado = threading.Event()
+        self.futuro = None
+
+    def avanzar(self, etapa, progreso):
+        """Registra la etapa actual; si el trabajo fue cancelado lo interrumpe aquí"""
+        if self.cancelado.is_set():
+            raise CancelledError()
+        self.etapa = etapa
+        self.progreso = progreso
+
+@st.cache_resource
+def registro_trabajos():
+    """Trabajos en curso compartidos por todas las sesiones, indexados por su clave"""
+    return {'trabajos': {}, 'candado': threading.RLock()}
+
+def enviar_trabajo(clave, funcion, *argumentos):
+    """
+    Envía un trabajo al pool. Si ya hay uno en curso con la misma clave (por ejemplo,
+    otra sesión pidió el mismo análisis) se reutiliza en lugar de calcularlo dos veces.
+    """
+    registro = registro_trabajos()
+    with registro['candado']:
+        trabajo = registro['trabajos'].get(clave)
+        if trabajo is None:
+            trabajo = Trabajo(clave)
+            registro['trabajos'][clave] = trabajo
+            trabajo.futuro = obtener_ejecutor().submit(
+                ejecutar_trabajo, obtener_almacen(), funcion, argumentos, trabajo
+            )
+            trabajo.futuro.add_done_callback(lambda _: retirar_trabajo(trabajo))
+        trabajo.suscriptores += 1
+    return trabajo
+
+def retirar_trabajo(trabajo):
+    """Quita un trabajo del registro de trabajos en curso"""
+    registro = registro_trabajos()
+    with registro['candado']:
+        if registro['trabajos'].get(trabajo.clave) is trabajo:
+            del registro['trabajos'][trabajo.clave]
+
+def liberar_trabajo(trabajo):
+    """Una sesión deja de esperar el trabajo; si nadie más lo espera, se cancela"""
+    registro = registro_trabajos()
+    with registro['candado']:
+        trabajo.suscriptores -= 1
+        if trabajo.suscriptores <= 0 and not trabajo.futuro.done():
+            trabajo.cancelado.set()
+            trabajo.futuro.cancel()
+            retirar_trabajo(trabajo)
+
+def vigilar_trabajo(clave_estado, clave):
+    """
+    Devuelve el trabajo guardado en la sesión. Si fue lanzado con otros filtros o con
+    otro año, se libera (y se cancela si seguía en curso) y se devuelve None.
+    """
+    trabajo = st.session_state.get(clave_estado)
+    if trabajo is not None and trabajo.clave != clave:
+        if not trabajo.futuro.done():
+            st.warning("⚠️ Cambiaron los filtros o el año: se canceló el análisis en curso.")
+        liberar_trabajo(trabajo)
+        del st.session_state[clave_estado]
+        trabajo = None
+    return trabajo
+
+def iniciar_trabajo(clave_estado, clave, funcion, *argumentos):
+    """Lanza el trabajo de la sesión, salvo que el mismo ya esté en curso"""
+    trabajo = st.session_state.get(clave_estado)
+    if trabajo is not None:
+        if trabajo.clave == clave and not trabajo.futuro.done():
+            return trabajo
+        liberar_trabajo(trabajo)
+    trabajo = enviar_trabajo(clave, funcion, *argumentos)
+    st.session_state[clave_estado] = trabajo
+    return trabajo
+
+@st.fragment(run_every=1)
+def seguimiento_trabajo(clave_estado):
+    """Muestra la etapa del trabajo en curso y permite cancelarlo, sin volver a ejecutar toda la página"""
+    trabajo = st.session_state.get(clave_estado)
+    if trabajo is None:
+        return
+    st.progress(trabajo.progreso, text=f"⏳ {trabajo.etapa}")
+    if st.button("✖️ Cancelar análisis", key=f'cancelar_{clave_estado}'):
+        liberar_trabajo(trabajo)
+        del st.session_state[clave_estado]
+        st.rerun()
+    if trabajo.futuro.done():
+        # Una sola ejecución completa para mostrar los resultados
+        st.rerun()
+
+
 def analisis_recompra(df, año_actual):
     """
     Función principal que realiza el análisis de recompra de los 3 años anteriores.
-    Incluye filtros, procesamiento y visualización de datos.
+    Incluye filtros y visualización; el procesamiento corre como trabajo en segundo plano.
     """
     años_anteriores = [año_actual - 1, año_actual - 2, año_actual - 3]
     año_1, año_2, año_3 = años_anteriores[0], años_anteriores[1], años_anteriores[2]
@@ -42,706 +692,1482 @@ def analisis_recompra(df, año_actual):
     st.header("🔍 Filtros de Análisis")
     st.info(f"📅 Analizando los años: **{año_3}, {año_2}, {año_1}** (3 años anteriores)")
 
+    filtros = seccion_filtros(df)
+
+    st.markdown("---")
+
+    # Motor de cálculo: exacto (por defecto) o aproximado con bocetos HyperLogLog
+    motor = st.radio(
+        "⚙️ Motor de cálculo:",
+        ["Exacto", "Aproximado (HyperLogLog)"],
+        horizontal=True,
+        key='motor_recompra',
+        help="El modo aproximado responde al instante combinando bocetos precalculados; úsalo para explorar y vuelve a Exacto para cifras definitivas y descargas."
+    )
+
+    if motor != "Exacto":
+        bocetos = construir_bocetos(df, df.attrs.get('huella'))
+        st.caption(f"Bocetos precalculados: {len(bocetos['combinaciones']):,} combinaciones, "
+                   f"{bocetos['tamaño'] / (1024 * 1024):,.1f} MB de registros")
+        resultado = estimar_recompra_aproximada(bocetos, año_actual, filtros)
+        if resultado['total'] == 0:
+            st.error("❌ No hay datos que coincidan con los filtros seleccionados. Por favor, ajusta tus criterios.")
+        else:
+            mostrar_resultados_aproximados(resultado)
+        return
+
+    # Modo multi-año: todos los años del selector en un solo cálculo
+    modo_multianual = st.toggle(
+        "📆 Precalcular todos los años de referencia",
+        key='modo_multianual',
+        help="Calcula de una vez todos los años del selector: cambiar de año es inmediato y se muestra la tendencia de recompra."
+    )
+
+    # Un cambio de filtros (o de año, fuera del modo multi-año) cancela el análisis en curso
+    if modo_multianual:
+        años_referencia = años_de_referencia()
+        clave = ('recompra_multianual', df.attrs.get('huella'), tuple(años_referencia), filtros)
+    else:
+        clave = ('recompra', df.attrs.get('huella'), año_actual, filtros)
+    trabajo = vigilar_trabajo('trabajo_recompra', clave)
+
+    # Botón de análisis
+    if st.button("🚀 ANALIZAR DATOS", type="primary", use_container_width=True, key='btn_analizar_recompra'):
+        if modo_multianual:
+            trabajo = iniciar_trabajo('trabajo_recompra', clave, calcular_recompra_multianual, df, años_referencia, filtros)
+        else:
+            trabajo = iniciar_trabajo('trabajo_recompra', clave, calcular_recompra, df, año_actual, filtros)
+
+    if trabajo is None:
+        return
+
+    if not trabajo.futuro.done():
+        seguimiento_trabajo('trabajo_recompra')
+        return
+
+    if trabajo.futuro.cancelled() or trabajo.cancelado.is_set():
+        del st.session_state['trabajo_recompra']
+        return
+
+    error = trabajo.futuro.exception()
+    if error is not None:
+        del st.session_state['trabajo_recompra']
+        st.error(f"❌ Error al procesar los datos: {error}")
+        return
+
+    resultado = trabajo.futuro.result()
+    tendencia = None
+    if modo_multianual:
+        # Cambiar de año solo consulta el resultado ya calculado
+        tendencia = resultado['tendencia']
+        resultado = resultado['por_año'][año_actual]
+
+    # Verificar si hay datos después del filtro
+    if resultado['registros'] == 0:
+        st.error("❌ No hay datos que coincidan con los filtros seleccionados. Por favor, ajusta tus criterios.")
+    else:
+        st.success(f"✅ Se encontraron {resultado['registros']} registros con los filtros aplicados")
+        mostrar_resultados_recompra(resultado, clave + (año_actual,))
+
+    if tendencia is not None:
+        mostrar_tendencia_recompra(tendencia, año_actual)
+
+def calcular_recompra(df, año_actual, filtros, trabajo):
+    """
+    Procesamiento del análisis de recompra (sin interfaz): visitas por cliente y año,
+    y recompra entre los 3 años anteriores. Se ejecuta en segundo plano.
+    """
+    años_anteriores = [año_actual - 1, año_actual - 2, año_actual - 3]
+    columna_id = df.columns[3]  # Código de cliente
+    columna_nombre = df.columns[4]  # Nombre
+
+    # Aplicar filtros y ventana de los 3 años anteriores en una sola pasada
+    trabajo.avanzar('Aplicando filtros...', 0.1)
+    df_filtrado = aplicar_filtros(df, filtros, columnas=[3, 4], años=años_anteriores)
+
+    if len(df_filtrado) == 0:
+        return {'registros': 0}
+
+    # Procesar datos
+    trabajo.avanzar('Contando visitas por cliente...', 0.4)
+    visitas = visitas_por_cliente(df_filtrado, columna_id, columna_nombre)
+
+    trabajo.avanzar('Calculando recompra entre años...', 0.8)
+    return resultado_recompra(visitas, len(df_filtrado), año_actual)
+
+def calcular_recompra_multianual(df, años_referencia, filtros, trabajo):
+    """
+    Modo multi-año: calcula recompra y fidelización para todos los años de referencia
+    en una sola pasada. Las visitas por cliente y año se agrupan una vez, y cada año
+    de referencia se obtiene tomando su ventana de 3 años sobre esa tabla.
+    """
+    años_necesarios = list(range(min(años_referencia) - 3, max(años_referencia) + 1))
+    columna_id = df.columns[3]  # Código de cliente
+    columna_nombre = df.columns[4]  # Nombre
+
+    # Aplicar filtros y ventana de años en una sola pasada
+    trabajo.avanzar('Aplicando filtros...', 0.1)
+    df_filtrado = aplicar_filtros(df, filtros, columnas=[3, 4], años=años_necesarios)
+
+    # Una sola pasada: visitas por cliente y año, y presencia de cada cliente por año
+    trabajo.avanzar('Contando visitas por cliente y año...', 0.3)
+    registros_por_año = df_filtrado['Año'].value_counts()
+    visitas = visitas_por_cliente(df_filtrado, columna_id, columna_nombre)
+    presencia = df_filtrado.dropna(subset=[columna_id]).groupby([columna_id, 'Año']).size().unstack('Año', fill_value=0) > 0
+
+    por_año = {}
+    filas_tendencia = []
+    for numero, año in enumerate(sorted(años_referencia)):
+        trabajo.avanzar(f'Calculando año de referencia {año}...', 0.5 + 0.5 * numero / len(años_referencia))
+        ventana = [año - 1, año - 2, año - 3]
+
+        # Recompra: ventana de 3 años sobre la tabla de visitas
+        registros = int(registros_por_año.reindex(ventana, fill_value=0).sum())
+        resultado = resultado_recompra(visitas, registros, año) if registros > 0 else {'registros': 0}
+        por_año[año] = resultado
+
+        # Fidelización: clientes de la ventana que compraron en el año de referencia
+        anteriores = presencia.reindex(columns=ventana, fill_value=False).any(axis=1)
+        actuales = presencia.reindex(columns=[año], fill_value=False)[año]
+        clientes_anteriores = int(anteriores.sum())
+        regresaron = int((anteriores & actuales).sum())
+
+        porcentajes = resultado.get('porcentajes', [0, 0, 0, 0])
+        filas_tendencia.append({
+            'Año de referencia': año,
+            'Clientes año anterior': resultado.get('clientes_por_año', {}).get(str(año - 1), 0),
+            '% Recompra año anterior': porcentajes[0],
+            '% Recompra los 3 años': porcentajes[3],
+            'Clientes años anteriores': clientes_anteriores,
+            'Regresaron': regresaron,
+            'No regresaron': clientes_anteriores - regresaron,
+            '% Regreso': (regresaron / clientes_anteriores) * 100 if clientes_anteriores > 0 else 0
+        })
+
+    return {
+        'por_año': por_año,
+        'tendencia': pd.DataFrame(filas_tendencia)
+    }
+
+def visitas_por_cliente(df_filtrado, columna_id, columna_nombre):
+    """Tabla ancha de visitas: una fila por cliente (código y nombre) y una columna por año"""
+    df_limpio = df_filtrado.dropna(subset=[columna_id, columna_nombre])
+
+    return df_limpio.groupby([columna_id, columna_nombre, 'Año']).size().unstack('Año', fill_value=0)
+
+def resultado_recompra(visitas, registros, año_actual):
+    """
+    Métricas de recompra de un año de referencia, tomando de la tabla ancha de visitas
+    solo los 3 años anteriores y los clientes que compraron en alguno de ellos.
+    """
+    años_anteriores = [año_actual - 1, año_actual - 2, año_actual - 3]
+    año_1, año_2, año_3 = años_anteriores[0], años_anteriores[1], años_anteriores[2]
+
+    columnas_ventana = [año for año in sorted(años_anteriores) if año in visitas.columns]
+    ventana = visitas[columnas_ventana]
+    ventana = ventana.loc[ventana.sum(axis=1) > 0, ventana.sum(axis=0) > 0]
+
+    tabla_final = ventana.reset_index()
+    tabla_final.columns.name = None
+    for año in ventana.columns:
+        tabla_final.rename(columns={año: f'Visitas_{int(año)}'}, inplace=True)
+
+    columnas_visitas = [col for col in tabla_final.columns if str(col).startswith('Visitas_')]
+    tabla_final['Total_Visitas'] = tabla_final[columnas_visitas].sum(axis=1)
+    tabla_final = tabla_final.sort_values('Total_Visitas', ascending=False)
+
+    # Calcular métricas
+    clientes_por_año = {}
+
+    for año in años_anteriores:
+        col_año = f'Visitas_{año}'
+        if col_año in tabla_final.columns:
+            clientes_por_año[str(año)] = len(tabla_final[tabla_final[col_año] > 0])
+
+    # Calcular recompras entre años
+    clientes_año1_año2 = 0
+    clientes_año2_año3 = 0
+    clientes_año1_año3 = 0
+    clientes_tres_años = 0
+
+    col_año1 = f'Visitas_{año_1}'
+    col_año2 = f'Visitas_{año_2}'
+    col_año3 = f'Visitas_{año_3}'
+
+    if col_año1 in tabla_final.columns and col_año2 in tabla_final.columns:
+        clientes_año1_año2 = len(tabla_final[(tabla_final[col_año1] > 0) & (tabla_final[col_año2] > 0)])
+
+    if col_año2 in tabla_final.columns and col_año3 in tabla_final.columns:
+        clientes_año2_año3 = len(tabla_final[(tabla_final[col_año2] > 0) & (tabla_final[col_año3] > 0)])
+
+    if col_año1 in tabla_final.columns and col_año3 in tabla_final.columns:
+        clientes_año1_año3 = len(tabla_final[(tabla_final[col_año1] > 0) & (tabla_final[col_año3] > 0)])
+
+    if all(col in tabla_final.columns for col in [col_año1, col_año2, col_año3]):
+        clientes_tres_años = len(tabla_final[(tabla_final[col_año1] > 0) &
+                                              (tabla_final[col_año2] > 0) &
+                                              (tabla_final[col_año3] > 0)])
+
+    total_clientes_año1 = clientes_por_año.get(str(año_1), 0)
+
+    categorias = [f'{año_2} a {año_1}', f'{año_3} a {año_2}', f'{año_3} a {año_1}', 'Los 3 años']
+    valores = [clientes_año1_año2, clientes_año2_año3, clientes_año1_año3, clientes_tres_años]
+
+    if total_clientes_año1 > 0:
+        porcentajes = [(v / total_clientes_año1) * 100 for v in valores]
+    else:
+        porcentajes = [0, 0, 0, 0]
+
+    return {
+        'registros': registros,
+        'tabla_final': tabla_final,
+        'columnas_visitas': columnas_visitas,
+        'clientes_por_año': clientes_por_año,
+        'categorias': categorias,
+        'valores': valores,
+        'porcentajes': porcentajes,
+        'año_1': año_1,
+        'año_2': año_2,
+        'año_3': año_3
+    }
+
+@st.fragment
+def mostrar_resultados_recompra(resultado, clave):
+    """
+    Muestra métricas, gráficas y descargas de un análisis de recompra ya calculado.
+    Es un fragmento: sus interacciones no vuelven a ejecutar el resto de la página.
+    """
+    tabla_final = resultado['tabla_final']
+    clientes_por_año = resultado['clientes_por_año']
+    categorias = resultado['categorias']
+    valores = resultado['valores']
+    porcentajes = resultado['porcentajes']
+    año_1 = resultado['año_1']
+    año_2 = resultado['año_2']
+    año_3 = resultado['año_3']
+
+    # Mostrar métricas principales
+    st.markdown("---")
+    st.header("📈 Métricas Principales")
+
     col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Total Clientes Únicos", len(tabla_final))
+    with col2:
+        st.metric(f"Clientes {año_3}", clientes_por_año.get(str(año_3), 0))
+    with col3:
+        st.metric(f"Clientes {año_2}", clientes_por_año.get(str(año_2), 0))
+    with col4:
+        st.metric(f"Clientes {año_1}", clientes_por_año.get(str(año_1), 0))
 
-    # Obtener nombres de columnas
-    columna_tipo_asesor = df.columns[11]  # Columna L
-    columna_departamento = df.columns[13]  # Columna N
-    columna_familia = df.columns[18]  # Columna S
-    columna_area = df.columns[22]  # Columna W
+    # GRÁFICAS
+    st.markdown("---")
+    st.header("📊 Gráficas de Análisis")
+
+    # Gráfica 1
+    st.subheader("Gráfica 1: Total de clientes por año")
+    fig1, ax1 = plt.subplots(figsize=(10, 6))
+    años_labels = list(clientes_por_año.keys())
+    valores_años = list(clientes_por_año.values())
+    colores_años = ['#f39c12', '#16a085', '#8e44ad']
+
+    barras = ax1.bar(años_labels, valores_años, color=colores_años[:len(años_labels)],
+                     edgecolor='black', linewidth=1.5, width=0.6)
+
+    for barra, valor in zip(barras, valores_años):
+        altura = barra.get_height()
+        ax1.text(barra.get_x() + barra.get_width()/2., altura,
+                f'{int(valor)}', ha='center', va='bottom', fontsize=13, fontweight='bold')
+
+    ax1.set_title('Gráfica 1: Total de clientes por año', fontsize=15, fontweight='bold', pad=20)
+    ax1.set_ylabel('Número de Clientes', fontsize=12)
+    ax1.set_xlabel('Año', fontsize=12)
+    ax1.grid(axis='y', alpha=0.3, linestyle='--')
+    plt.tight_layout()
+    st.pyplot(fig1)
+    plt.close(fig1)
+
+    # Gráfica 2
+    st.subheader("Gráfica 2: Cantidad de recompra en combinaciones por años")
+    fig2, ax2 = plt.subplots(figsize=(10, 6))
+    colores = ['#3498db', '#2ecc71', '#e74c3c', '#9b59b6']
+
+    barras = ax2.bar(categorias, valores, color=colores, edgecolor='black', linewidth=1.5)
+
+    for barra, valor in zip(barras, valores):
+        altura = barra.get_height()
+        ax2.text(barra.get_x() + barra.get_width()/2., altura,
+                f'{int(valor)}', ha='center', va='bottom', fontsize=12, fontweight='bold')
+
+    ax2.set_title('Gráfica 2: Cantidad de recompra en combinaciones por años',
+                 fontsize=15, fontweight='bold', pad=20)
+    ax2.set_ylabel('Número de Clientes', fontsize=12)
+    ax2.grid(axis='y', alpha=0.3, linestyle='--')
+    plt.xticks(rotation=15, ha='right')
+    plt.tight_layout()
+    st.pyplot(fig2)
+    plt.close(fig2)
+
+    # Gráfica 3
+    st.subheader(f"Gráfica 3: Porcentaje de recompra en relación a clientes {año_1}")
+    fig3, ax3 = plt.subplots(figsize=(10, 6))
+
+    barras = ax3.bar(categorias, porcentajes, color=colores, edgecolor='black', linewidth=1.5)
+
+    for barra, porcentaje in zip(barras, porcentajes):
+        altura = barra.get_height()
+        ax3.text(barra.get_x() + barra.get_width()/2., altura,
+                f'{porcentaje:.1f}%', ha='center', va='bottom', fontsize=12, fontweight='bold')
+
+    ax3.set_title(f'Gráfica 3: Porcentaje de recompra en relación a cantidad de clientes {año_1}',
+                 fontsize=15, fontweight='bold', pad=20)
+    ax3.set_ylabel('Porcentaje (%)', fontsize=12)
+    ax3.grid(axis='y', alpha=0.3, linestyle='--')
+    plt.xticks(rotation=15, ha='right')
+    ax3.set_ylim(0, max(porcentajes) * 1.15 if max(porcentajes) > 0 else 100)
+    plt.tight_layout()
+    st.pyplot(fig3)
+    plt.close(fig3)
+
+    # DESCARGAS
+    descargas_recompra(resultado, clave)
+
+    st.success("✅ Análisis completado exitosamente!")
+
+def descarga_memorizada(nombre, clave, construir):
+    """
+    Genera los archivos de una descarga una sola vez por resultado y los guarda en la
+    sesión, para no reconstruirlos en cada ejecución de la página.
+    """
+    guardada = st.session_state.get(nombre)
+    if guardada is None or guardada[0] != clave:
+        guardada = (clave, construir())
+        st.session_state[nombre] = guardada
+    return guardada[1]
+
+def archivos_recompra(resultado):
+    """Excel completo y CSV de datos de un análisis de recompra"""
+    tabla_final = resultado['tabla_final']
+    columnas_visitas = resultado['columnas_visitas']
+    clientes_por_año = resultado['clientes_por_año']
+    categorias = resultado['categorias']
+    valores = resultado['valores']
+    porcentajes = resultado['porcentajes']
+    año_1 = resultado['año_1']
+
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        stats_generales = pd.DataFrame({
+            'Métrica': ['Total de clientes únicos', 'Años analizados'],
+            'Valor': [len(tabla_final), ', '.join([col.replace('Visitas_', '') for col in columnas_visitas])]
+        })
+        stats_generales.to_excel(writer, sheet_name='Estadísticas Generales', index=False)
+
+        clientes_año_df = pd.DataFrame({
+            'Año': list(clientes_por_año.keys()),
+            'Total de Clientes': list(clientes_por_año.values())
+        })
+        clientes_año_df.to_excel(writer, sheet_name='Clientes por Año', index=False)
+
+        retencion_df = pd.DataFrame({
+            'Combinación de Años': categorias,
+            'Cantidad de Clientes': valores
+        })
+        retencion_df.to_excel(writer, sheet_name='Retención de Clientes', index=False)
+
+        porcentajes_df = pd.DataFrame({
+            'Combinación de Años': categorias,
+            'Cantidad de Clientes': valores,
+            f'Porcentaje respecto a {año_1}': [f"{p:.2f}%" for p in porcentajes]
+        })
+        porcentajes_df.to_excel(writer, sheet_name='Resumen de Porcentajes', index=False)
+
+        tabla_final.to_excel(writer, sheet_name='Datos Completos', index=False)
+
+    csv = tabla_final.to_csv(index=False, encoding='utf-8-sig')
+    return output.getvalue(), csv
+
+@st.fragment
+def descargas_recompra(resultado, clave):
+    """Botones de descarga del análisis de recompra; descargar solo vuelve a ejecutar esta sección"""
+    st.markdown("---")
+    st.header("💾 Descargar Resultados")
+
+    col1, col2 = st.columns(2)
+
+    excel, csv = descarga_memorizada('descarga_recompra', clave, lambda: archivos_recompra(resultado))
 
     with col1:
-        st.subheader("👤 Asesor")
-        valores_asesor = ['Todos'] + sorted(df[columna_tipo_asesor].dropna().unique().tolist())
-        filtro_asesor = st.multiselect(
-            "Selecciona tipo(s) de asesor:",
-            valores_asesor,
-            default=['Todos'],
-            key='asesor'
+        # Excel
+        st.download_button(
+            label="📥 Descargar Excel Completo",
+            data=excel,
+            file_name="analisis_completo_clientes.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
 
     with col2:
-        st.subheader("🏢 CDS")
-        valores_depto = ['Todos'] + sorted(df[columna_departamento].dropna().unique().tolist())
-        filtro_depto = st.multiselect(
-            "Selecciona departamento(s):",
-            valores_depto,
-            default=['Todos'],
-            key='depto'
+        # CSV
+        st.download_button(
+            label="📥 Descargar CSV de Datos",
+            data=csv,
+            file_name="frecuencia_clientes.csv",
+            mime="text/csv"
         )
 
-    with col3:
-        st.subheader("🛞 Producto")
-        valores_familia = ['Todos'] + sorted(df[columna_familia].dropna().unique().tolist())
-        filtro_familia = st.multiselect(
-            "Selecciona familia(s):",
-            valores_familia,
-            default=['Todos'],
-            key='familia'
-        )
+@st.cache_resource(max_entries=2)
+def construir_bocetos(_df, huella):
+    """
+    Bocetos HyperLogLog de clientes distintos, uno por cada combinación de asesor, CDS,
+    familia, área y año presente en los datos. Se construyen una vez por conjunto de
+    datos (identificado por su huella) y se comparten entre sesiones.
+
+    La mayoría de las combinaciones finas tienen pocos clientes, así que solo los bocetos
+    con más de UMBRAL_BOCETO_DENSO registros ocupados se guardan densos (4 KB cada uno);
+    el resto se guarda disperso, a 7 bytes por registro ocupado. El tamaño total queda
+    acotado por el menor entre 7 bytes por fila de datos y 4 KB por combinación, y se
+    informa en 'tamaño' (bytes).
+    """
+    columna_fecha = _df.columns[2]
+    columna_id = _df.columns[3]
+    posiciones = [posicion for _, posicion, _, _ in FILTROS_DIMENSION]
+    columnas = [_df.columns[posicion] for posicion in posiciones]
+    filas = aplicar_filtros(_df, (), columnas=[3] + posiciones, sin_vacios=[columna_id, columna_fecha])
+
+    # Llave entera por combinación: cada dimensión codificada (0 = sin dato) más el año
+    codigos_columnas = []
+    valores_columnas = []
+    for columna in columnas:
+        codigos, valores = pd.factorize(filas[columna])
+        codigos_columnas.append(codigos.astype(np.int64) + 1)
+        valores_columnas.append(valores)
+    años = filas['Año'].to_numpy().astype(np.int64)
+    año_minimo = años.min() if len(años) > 0 else 0
+    codigos_columnas.append(años - año_minimo)
+    bases = [len(valores) + 1 for valores in valores_columnas] + [int(años.max() - año_minimo) + 1 if len(años) > 0 else 1]
+
+    llave = np.zeros(len(filas), dtype=np.int64)
+    for codigos, base in zip(codigos_columnas, bases):
+        llave = llave * base + codigos
+    numero_boceto, llaves_unicas = pd.factorize(llave)
+
+    # Decodificar cada llave única en sus valores de dimensión y año
+    combinaciones = {}
+    resto = np.asarray(llaves_unicas, dtype=np.int64)
+    for posicion in range(len(bases) - 1, -1, -1):
+        resto, codigos = np.divmod(resto, bases[posicion])
+        if posicion == len(bases) - 1:
+            combinaciones['Año'] = codigos + año_minimo
+        else:
+            valores = valores_columnas[posicion]
+            combinaciones[columnas[posicion]] = np.where(
+                codigos > 0, np.asarray(valores, dtype=object)[np.maximum(codigos - 1, 0)], None
+            ) if len(valores) > 0 else np.full(len(codigos), None, dtype=object)
+    combinaciones = pd.DataFrame(combinaciones)
+
+    # Registro y posición del primer bit en 1 de cada cliente (hash de 64 bits)
+    m = 1 << PRECISION_HLL
+    hashes = pd.util.hash_array(filas[columna_id].to_numpy())
+    registro = (hashes >> np.uint64(64 - PRECISION_HLL)).astype(np.int64)
+    # Bits restantes más un bit centinela; con PRECISION_HLL >= 12 caben exactos en un float64
+    resto_bits = ((hashes << np.uint64(PRECISION_HLL)) >> np.uint64(PRECISION_HLL - 1)) | np.uint64(1)
+    rho = (65 - PRECISION_HLL - np.floor(np.log2(resto_bits.astype(np.float64)))).astype(np.uint8)
+
+    # Pares únicos (boceto, registro) con su valor máximo
+    par = numero_boceto.astype(np.int64) * m + registro
+    orden = np.lexsort((rho, par))
+    par = par[orden]
+    ultimo = np.append(par[1:] != par[:-1], True) if len(par) > 0 else np.zeros(0, dtype=bool)
+    par = par[ultimo]
+    rho = rho[orden][ultimo]
+    boceto_par = par // m
+    registro_par = (par % m).astype(np.uint16)
+
+    # Densos los bocetos con muchos registros ocupados; dispersos los demás
+    ocupados = np.bincount(boceto_par, minlength=len(combinaciones))
+    es_denso = ocupados > UMBRAL_BOCETO_DENSO
+    fila_densa = np.full(len(combinaciones), -1, dtype=np.int64)
+    fila_densa[es_denso] = np.arange(np.count_nonzero(es_denso))
+    densos = np.zeros((np.count_nonzero(es_denso), m), dtype=np.uint8)
+    par_denso = es_denso[boceto_par]
+    densos[fila_densa[boceto_par[par_denso]], registro_par[par_denso]] = rho[par_denso]
+
+    disperso = ~par_denso
+    bocetos = {
+        'combinaciones': combinaciones,
+        'registros_por_boceto': m,
+        'fila_densa': fila_densa,
+        'densos': densos,
+        'boceto_disperso': boceto_par[disperso].astype(np.int32),
+        'registro_disperso': registro_par[disperso],
+        'valor_disperso': rho[disperso]
+    }
+    bocetos['tamaño'] = sum(valor.nbytes for valor in bocetos.values() if isinstance(valor, np.ndarray))
+    return bocetos
+
+def unir_bocetos(bocetos, seleccion):
+    """Boceto de la unión (máximo por registro) de las combinaciones marcadas en `seleccion`"""
+    filas_densas = bocetos['fila_densa'][seleccion]
+    filas_densas = filas_densas[filas_densas >= 0]
+    if len(filas_densas) > 0:
+        unido = bocetos['densos'][filas_densas].max(axis=0)
+    else:
+        unido = np.zeros(bocetos['registros_por_boceto'], dtype=np.uint8)
+    en_seleccion = seleccion[bocetos['boceto_disperso']]
+    np.maximum.at(unido, bocetos['registro_disperso'][en_seleccion], bocetos['valor_disperso'][en_seleccion])
+    return unido
+
+def estimar_cardinalidad(registros):
+    """Estimador HyperLogLog de elementos distintos, con corrección por rango pequeño"""
+    m = len(registros)
+    alfa = 0.7213 / (1 + 1.079 / m)
+    estimado = alfa * m * m / np.sum(np.power(2.0, -registros.astype(np.float64)))
+    vacios = np.count_nonzero(registros == 0)
+    if estimado <= 2.5 * m and vacios > 0:
+        estimado = m * np.log(m / vacios)
+    return float(estimado)
+
+def estimar_recompra_aproximada(bocetos, año_actual, filtros):
+    """
+    Estima las métricas de recompra uniendo bocetos (máximo por registro) según los filtros.
+    Las intersecciones entre años salen por inclusión-exclusión; los márgenes son
+    intervalos de 95% a partir del error estándar de HyperLogLog.
+    """
+    años_anteriores = [año_actual - 1, año_actual - 2, año_actual - 3]
+    año_1, año_2, año_3 = años_anteriores[0], años_anteriores[1], años_anteriores[2]
 
-    with col4:
-        st.subheader("📍 Área")
-        valores_area = ['Todos'] + sorted(df[columna_area].dropna().unique().tolist())
-        filtro_area = st.multiselect(
-            "Selecciona área(s):",
-            valores_area,
-            default=['Todos'],
-            key='area'
-        )
+    combinaciones = bocetos['combinaciones']
+    seleccion = np.ones(len(combinaciones), dtype=bool)
+    for columna, valores in filtros:
+        seleccion &= combinaciones[columna].isin(valores).to_numpy()
+
+    def clientes(años):
+        filas = seleccion & combinaciones['Año'].isin(años).to_numpy()
+        if not filas.any():
+            return 0.0
+        return estimar_cardinalidad(unir_bocetos(bocetos, filas))
+
+    error_relativo = 1.04 / np.sqrt(bocetos['registros_por_boceto'])
+    z = 1.96
+
+    n1, n2, n3 = clientes([año_1]), clientes([año_2]), clientes([año_3])
+    n12, n23, n13 = clientes([año_1, año_2]), clientes([año_2, año_3]), clientes([año_1, año_3])
+    total = clientes(años_anteriores)
+
+    # Inclusión-exclusión (las estimaciones negativas se truncan en cero)
+    i12 = max(0.0, n1 + n2 - n12)
+    i23 = max(0.0, n2 + n3 - n23)
+    i13 = max(0.0, n1 + n3 - n13)
+    i123 = max(0.0, total - n1 - n2 - n3 + i12 + i23 + i13)
+
+    valores = [i12, i23, i13, i123]
+    margenes = [
+        z * error_relativo * (n1 + n2 + n12),
+        z * error_relativo * (n2 + n3 + n23),
+        z * error_relativo * (n1 + n3 + n13),
+        z * error_relativo * (total + n1 + n2 + n3 + n12 + n23 + n13)
+    ]
+
+    if n1 > 0:
+        porcentajes = [(v / n1) * 100 for v in valores]
+    else:
+        porcentajes = [0, 0, 0, 0]
+
+    return {
+        'total': total,
+        'margen_total': z * error_relativo * total,
+        'clientes_por_año': {str(año_3): n3, str(año_2): n2, str(año_1): n1},
+        'categorias': [f'{año_2} a {año_1}', f'{año_3} a {año_2}', f'{año_3} a {año_1}', 'Los 3 años'],
+        'valores': valores,
+        'margenes': margenes,
+        'porcentajes': porcentajes,
+        'error_relativo': error_relativo,
+        'año_1': año_1,
+        'año_3': año_3
+    }
+
+def mostrar_resultados_aproximados(resultado):
+    """Muestra las métricas estimadas con sus márgenes de error"""
+    error_relativo = resultado['error_relativo']
 
     st.markdown("---")
+    st.header("📈 Métricas Principales (aproximadas)")
+    st.info(f"≈ Estimaciones HyperLogLog: error estándar de {error_relativo * 100:.1f}% por conteo; "
+            f"los márgenes (±) son intervalos de 95%. Cambia el motor a **Exacto** para cifras definitivas y descargas.")
 
-    # Botón de análisis
-    if st.button("🚀 ANALIZAR DATOS", type="primary", use_container_width=True, key='btn_analizar_recompra'):
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Total Clientes Únicos", f"≈ {resultado['total']:,.0f}",
+                  help=f"± {resultado['margen_total']:,.0f}")
+    for col, (año, valor) in zip([col2, col3, col4], resultado['clientes_por_año'].items()):
+        with col:
+            st.metric(f"Clientes {año}", f"≈ {valor:,.0f}",
+                      help=f"± {1.96 * error_relativo * valor:,.0f}")
+
+    # Gráfica con barras de error
+    st.subheader("Recompra estimada en combinaciones por años")
+    fig, ax = plt.subplots(figsize=(10, 6))
+    colores = ['#3498db', '#2ecc71', '#e74c3c', '#9b59b6']
+
+    barras = ax.bar(resultado['categorias'], resultado['valores'], yerr=resultado['margenes'], capsize=8,
+                    color=colores, edgecolor='black', linewidth=1.5, alpha=0.85)
+
+    for barra, valor, porcentaje in zip(barras, resultado['valores'], resultado['porcentajes']):
+        ax.text(barra.get_x() + barra.get_width()/2., barra.get_height(),
+                f'≈{int(valor)}\n({porcentaje:.1f}%)', ha='center', va='bottom', fontsize=11, fontweight='bold')
+
+    ax.set_title(f'Recompra estimada (porcentaje respecto a clientes {resultado["año_1"]})',
+                 fontsize=15, fontweight='bold', pad=20)
+    ax.set_ylabel('Número de Clientes (estimado)', fontsize=12)
+    ax.grid(axis='y', alpha=0.3, linestyle='--')
+    plt.xticks(rotation=15, ha='right')
+    plt.tight_layout()
+    st.pyplot(fig)
+    plt.close(fig)
+
+    st.dataframe(
+        pd.DataFrame({
+            'Combinación de Años': resultado['categorias'],
+            'Clientes (estimado)': [round(v) for v in resultado['valores']],
+            'Margen ± (95%)': [round(m) for m in resultado['margenes']],
+            f'Porcentaje respecto a {resultado["año_1"]}': [f"{p:.1f}%" for p in resultado['porcentajes']]
+        }),
+        use_container_width=True,
+        hide_index=True
+    )
+
+def mostrar_tendencia_recompra(tendencia, año_actual):
+    """Muestra la tendencia de recompra y de regreso de clientes a lo largo de los años de referencia"""
+    st.markdown("---")
+    st.header("📉 Tendencia por Año de Referencia")
+
+    fig, ax = plt.subplots(figsize=(10, 6))
+    años = tendencia['Año de referencia']
+    ax.plot(años, tendencia['% Recompra año anterior'], marker='o', linewidth=2.5,
+            color='#3498db', label='% Recompra (2 años anteriores)')
+    ax.plot(años, tendencia['% Regreso'], marker='s', linewidth=2.5,
+            color='#2ecc71', label='% Regreso en el año de referencia')
+    ax.axvline(año_actual, color='#8e44ad', linestyle='--', alpha=0.6, label=f'Año seleccionado ({año_actual})')
+
+    ax.set_title('Tendencia de recompra por año de referencia', fontsize=15, fontweight='bold', pad=20)
+    ax.set_ylabel('Porcentaje (%)', fontsize=12)
+    ax.set_xlabel('Año de referencia', fontsize=12)
+    ax.set_xticks(list(años))
+    ax.grid(axis='y', alpha=0.3, linestyle='--')
+    ax.legend()
+    plt.tight_layout()
+    st.pyplot(fig)
+    plt.close(fig)
+
+    formato_porcentaje = st.column_config.NumberColumn(format="%.1f%%")
+    st.dataframe(
+        tendencia,
+        use_container_width=True,
+        hide_index=True,
+        column_config={
+            'Año de referencia': st.column_config.NumberColumn(format="%d"),
+            '% Recompra año anterior': formato_porcentaje,
+            '% Recompra los 3 años': formato_porcentaje,
+            '% Regreso': formato_porcentaje
+        }
+    )
 
-        with st.spinner('Procesando datos...'):
+def fidelizacion_clientes(df, año_actual):
+    """
+    Función que identifica clientes que NO han regresado en el año actual
+    pero que sí compraron en años anteriores.
+    Incluye filtros y muestra análisis detallado por año.
+    """
+    años_anteriores = [año_actual - 1, año_actual - 2, año_actual - 3]
+    año_1, año_2, año_3 = años_anteriores[0], años_anteriores[1], años_anteriores[2]
 
-            # Aplicar filtros
-            df_filtrado = df.copy()
+    st.header("🔄 Fidelización de Clientes")
+    st.info(f"📅 Año actual: **{año_actual}** | Años anteriores: **{año_1}, {año_2}, {año_3}**")
 
-            if 'Todos' not in filtro_asesor:
-                df_filtrado = df_filtrado[df_filtrado[columna_tipo_asesor].isin(filtro_asesor)]
+    # SECCIÓN DE FILTROS (igual que analisis_recompra)
+    st.header("🔍 Filtros de Análisis")
 
-            if 'Todos' not in filtro_depto:
-                df_filtrado = df_filtrado[df_filtrado[columna_departamento].isin(filtro_depto)]
+    filtros = seccion_filtros(df, sufijo='_fidelizacion')
 
-            if 'Todos' not in filtro_familia:
-                df_filtrado = df_filtrado[df_filtrado[columna_familia].isin(filtro_familia)]
+    st.markdown("---")
 
-            if 'Todos' not in filtro_area:
-                df_filtrado = df_filtrado[df_filtrado[columna_area].isin(filtro_area)]
+    # Un cambio de filtros o de año cancela el análisis que estuviera en curso
+    clave = ('fidelizacion', df.attrs.get('huella'), año_actual, filtros)
+    trabajo = vigilar_trabajo('trabajo_fidelizacion', clave)
 
-            # Filtrar solo los 3 años anteriores (la fecha ya viene convertida)
-            columna_fecha = df_filtrado.columns[2]
-            df_filtrado['Año'] = df_filtrado[columna_fecha].dt.year
-            df_filtrado = df_filtrado[df_filtrado['Año'].isin(años_anteriores)]
+    # Botón para ejecutar análisis
+    if st.button("🔍 ANALIZAR FIDELIZACIÓN", type="primary", use_container_width=True, key='btn_fidelizacion'):
+        trabajo = iniciar_trabajo('trabajo_fidelizacion', clave, calcular_fidelizacion, df, año_actual, filtros)
 
-            # Verificar si hay datos después del filtro
-            if len(df_filtrado) == 0:
-                st.error("❌ No hay datos que coincidan con los filtros seleccionados. Por favor, ajusta tus criterios.")
-            else:
-                st.success(f"✅ Se encontraron {len(df_filtrado)} registros con los filtros aplicados")
+    if trabajo is not None:
+        if not trabajo.futuro.done():
+            seguimiento_trabajo('trabajo_fidelizacion')
+        else:
+            del st.session_state['trabajo_fidelizacion']
+            if not (trabajo.futuro.cancelled() or trabajo.cancelado.is_set()):
+                error = trabajo.futuro.exception()
+                if error is not None:
+                    st.error(f"❌ Error al procesar los datos: {error}")
+                elif trabajo.futuro.result()['registros'] == 0:
+                    # Verificar si hay datos después del filtro
+                    st.error("❌ No hay datos que coincidan con los filtros seleccionados. Por favor, ajusta tus criterios.")
+                    # Limpiar session_state si no hay datos
+                    if 'fidelizacion_data' in st.session_state:
+                        del st.session_state['fidelizacion_data']
+                    descartar_exportacion()
+                else:
+                    # GUARDAR TODOS LOS DATOS EN SESSION_STATE
+                    st.session_state['fidelizacion_data'] = trabajo.futuro.result()
+                    st.session_state.pop('descargas_perdidos', None)
+                    descartar_exportacion()
+                    st.success(f"✅ Se encontraron {trabajo.futuro.result()['registros']} registros con los filtros aplicados")
 
-                # Procesar datos
-                columna_id = df_filtrado.columns[3]
-                columna_nombre = df_filtrado.columns[4]
+    # RENDERIZAR RESULTADOS SI EXISTEN EN SESSION_STATE
+    if 'fidelizacion_data' in st.session_state:
+        mostrar_resultados_fidelizacion(st.session_state['fidelizacion_data'])
+
+@st.fragment
+def mostrar_resultados_fidelizacion(data):
+    """
+    Resultados de fidelización: métricas, gráficas y listado de clientes perdidos.
+    Es un fragmento: sus interacciones no vuelven a ejecutar el resto de la página.
+    """
+    # Extraer datos de session_state
+    clientes_no_regresaron = data['clientes_no_regresaron']
+    clientes_regresaron = data['clientes_regresaron']
+    clientes_años_anteriores = data['clientes_años_anteriores']
+    total_clientes_año_actual = data['total_clientes_año_actual']
+    clientes_año_1_regresaron = data['clientes_año_1_regresaron']
+    clientes_año_2_regresaron = data['clientes_año_2_regresaron']
+    clientes_año_3_regresaron = data['clientes_año_3_regresaron']
+    año_actual = data['año_actual']
+    año_1 = data['año_1']
+    año_2 = data['año_2']
+    año_3 = data['año_3']
+    fecha_maxima = data['fecha_maxima']
+
+    # Mostrar métricas principales
+    st.markdown("---")
+    st.header("📊 Resultados de Fidelización")
+
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Clientes Años Anteriores", len(clientes_años_anteriores))
+    with col2:
+        st.metric("✅ Clientes que Regresaron", len(clientes_regresaron))
+    with col3:
+        st.metric("❌ Clientes que NO Regresaron", len(clientes_no_regresaron))
+    with col4:
+        st.metric(f"Clientes {año_actual}", total_clientes_año_actual)
 
-                df_limpio = df_filtrado.dropna(subset=[columna_id, columna_nombre])
+    # Mostrar última fecha de actualización
+    meses = {
+        1: 'enero', 2: 'febrero', 3: 'marzo', 4: 'abril',
+        5: 'mayo', 6: 'junio', 7: 'julio', 8: 'agosto',
+        9: 'septiembre', 10: 'octubre', 11: 'noviembre', 12: 'diciembre'
+    }
+    dia = fecha_maxima.day
+    mes = meses[fecha_maxima.month]
+    año = fecha_maxima.year
+    st.info(f"📅 Estos datos están actualizados al {dia} de {mes} de {año}")
 
-                visitas_por_año = df_limpio.groupby([columna_id, columna_nombre, 'Año']).size().reset_index(name='Visitas')
+    # GRÁFICAS
+    st.markdown("---")
+    st.header("📈 Análisis de Retorno por Año")
+
+    # Gráfica 1: Cantidad de clientes de cada año anterior que regresaron
+    st.subheader(f"Gráfica 1: Clientes de cada año anterior que regresaron en {año_actual}")
+
+    fig1, ax1 = plt.subplots(figsize=(10, 6))
+    categorias_años = [f'Del año {año_3}', f'Del año {año_2}', f'Del año {año_1}']
+    valores_regreso = [
+        len(clientes_año_3_regresaron),
+        len(clientes_año_2_regresaron),
+        len(clientes_año_1_regresaron)
+    ]
+    colores_años = ['#f39c12', '#16a085', '#8e44ad']
+
+    barras1 = ax1.bar(categorias_años, valores_regreso, color=colores_años,
+                     edgecolor='black', linewidth=1.5, width=0.6)
+
+    for barra, valor in zip(barras1, valores_regreso):
+        altura = barra.get_height()
+        ax1.text(barra.get_x() + barra.get_width()/2., altura,
+                f'{int(valor)}', ha='center', va='bottom', fontsize=13, fontweight='bold')
+
+    ax1.set_title(f'Clientes de cada año anterior que regresaron en {año_actual}',
+                 fontsize=15, fontweight='bold', pad=20)
+    ax1.set_ylabel('Número de Clientes', fontsize=12)
+    ax1.set_xlabel('Año de origen', fontsize=12)
+    ax1.grid(axis='y', alpha=0.3, linestyle='--')
+    plt.tight_layout()
+    st.pyplot(fig1)
+    plt.close(fig1)
+
+    # Gráfica 2: Porcentaje respecto al total del año actual
+    st.subheader(f"Gráfica 2: Porcentaje respecto a clientes únicos de {año_actual}")
+
+    fig2, ax2 = plt.subplots(figsize=(10, 6))
+
+    if total_clientes_año_actual > 0:
+        porcentajes = [
+            (len(clientes_año_3_regresaron) / total_clientes_año_actual) * 100,
+            (len(clientes_año_2_regresaron) / total_clientes_año_actual) * 100,
+            (len(clientes_año_1_regresaron) / total_clientes_año_actual) * 100
+        ]
+    else:
+        porcentajes = [0, 0, 0]
+
+    barras2 = ax2.bar(categorias_años, porcentajes, color=colores_años,
+                     edgecolor='black', linewidth=1.5, width=0.6)
+
+    for barra, porcentaje in zip(barras2, porcentajes):
+        altura = barra.get_height()
+        ax2.text(barra.get_x() + barra.get_width()/2., altura,
+                f'{porcentaje:.1f}%', ha='center', va='bottom', fontsize=13, fontweight='bold')
+
+    ax2.set_title(f'Porcentaje de clientes de años anteriores respecto a total de {año_actual}',
+                 fontsize=15, fontweight='bold', pad=20)
+    ax2.set_ylabel('Porcentaje (%)', fontsize=12)
+    ax2.set_xlabel('Año de origen', fontsize=12)
+    ax2.grid(axis='y', alpha=0.3, linestyle='--')
+    ax2.set_ylim(0, max(porcentajes) * 1.15 if max(porcentajes) > 0 else 100)
+    plt.tight_layout()
+    st.pyplot(fig2)
+    plt.close(fig2)
+
+    # Gráfica 3: Comparación de clientes que regresaron vs no regresaron
+    st.markdown("---")
+    st.subheader("Gráfica 3: Comparación general de fidelización")
+
+    fig3, ax3 = plt.subplots(figsize=(10, 6))
+    categorias = ['Clientes que\nRegresaron', 'Clientes que\nNO Regresaron']
+    valores = [len(clientes_regresaron), len(clientes_no_regresaron)]
+    colores = ['#2ecc71', '#e74c3c']
+
+    barras3 = ax3.bar(categorias, valores, color=colores, edgecolor='black', linewidth=1.5)
+
+    for barra, valor in zip(barras3, valores):
+        altura = barra.get_height()
+        ax3.text(barra.get_x() + barra.get_width()/2., altura,
+                f'{int(valor)}', ha='center', va='bottom', fontsize=13, fontweight='bold')
+
+    ax3.set_title(f'Comparación de Fidelización de Clientes en {año_actual}',
+                 fontsize=15, fontweight='bold', pad=20)
+    ax3.set_ylabel('Número de Clientes', fontsize=12)
+    ax3.grid(axis='y', alpha=0.3, linestyle='--')
+    plt.tight_layout()
+    st.pyplot(fig3)
+    plt.close(fig3)
+
+    # Obtener datos de clientes que no regresaron
+    if len(clientes_no_regresaron) > 0:
+        st.markdown("---")
+        st.header("📋 Listado de Clientes que NO Regresaron")
 
-                tabla_final = visitas_por_año.pivot_table(
-                    index=[columna_id, columna_nombre],
-                    columns='Año',
-                    values='Visitas',
-                    fill_value=0
-                ).reset_index()
+        listado_clientes_perdidos(data)
 
-                tabla_final.columns.name = None
-                año_cols = [col for col in tabla_final.columns if isinstance(col, (int, float))]
-                for año in año_cols:
-                    tabla_final.rename(columns={año: f'Visitas_{int(año)}'}, inplace=True)
+        st.success(f"✅ Análisis completado: {len(clientes_no_regresaron)} clientes no han regresado en {año_actual}")
+    else:
+        st.success("🎉 Excelente! Todos los clientes anteriores han regresado en el año actual.")
 
-                columnas_visitas = [col for col in tabla_final.columns if col.startswith('Visitas_')]
-                tabla_final['Total_Visitas'] = tabla_final[columnas_visitas].sum(axis=1)
-                tabla_final = tabla_final.sort_values('Total_Visitas', ascending=False)
+def filtrar_por_productos(df_perdidos, filtro_productos):
+    """Aplica el filtro post-análisis por tipo de producto al listado de clientes perdidos"""
+    if 'Todos' in filtro_productos or len(filtro_productos) == 0:
+        return df_perdidos
 
-                # Calcular métricas
-                clientes_por_año = {}
+    # Extraer nombres de productos sin el contador
+    productos_seleccionados = [p.rsplit(' (', 1)[0] for p in filtro_productos]
 
-                for año in años_anteriores:
-                    col_año = f'Visitas_{año}'
-                    if col_año in tabla_final.columns:
-                        clientes_por_año[str(año)] = len(tabla_final[tabla_final[col_año] > 0])
+    # Filtrar DataFrame: clientes con al menos uno de los productos seleccionados
+    productos = df_perdidos['Productos Comprados'].str.split(',').explode().str.strip()
+    mask = productos.isin(productos_seleccionados).groupby(level=0, sort=False).any()
+    return df_perdidos[mask.reindex(df_perdidos.index, fill_value=False).to_numpy()]
+
+@st.fragment
+def listado_clientes_perdidos(data):
+    """
+    Filtro por tipo de producto, tabla paginada y descargas; cambiarlos solo vuelve a
+    ejecutar esta sección. Las descargas están en el mismo fragmento que el filtro para
+    que reflejen siempre el filtro vigente.
+    """
+    # Listado de clientes perdidos e índice de búsqueda (calculados en el trabajo)
+    df_perdidos = data['df_perdidos']
+    indice_busqueda = data['indice_busqueda']
+
+    # FILTRO POST-ANÁLISIS: Filtrar por tipo de producto
+    st.subheader("🔍 Filtrar por Tipo de Producto")
+
+    # Productos y clientes por producto (calculados en el trabajo)
+    conteo_productos = data['conteo_productos']
+    opciones_productos = ['Todos'] + [
+        f"{producto} ({clientes} clientes)" for producto, clientes in conteo_productos.items()
+    ]
+
+    filtro_productos = st.multiselect(
+        "Selecciona tipo(s) de producto (puedes escribir para buscar):",
+        opciones_productos,
+        default=['Todos'],
+        help="Filtra clientes según los productos que compraron. Usa la búsqueda escribiendo parte del nombre.",
+        key='filtro_productos'
+    )
 
-                # Calcular recompras entre años
-                clientes_año1_año2 = 0
-                clientes_año2_año3 = 0
-                clientes_año1_año3 = 0
-                clientes_tres_años = 0
+    # Aplicar filtro de productos
+    df_mostrar = filtrar_por_productos(df_perdidos, filtro_productos)
 
-                col_año1 = f'Visitas_{año_1}'
-                col_año2 = f'Visitas_{año_2}'
-                col_año3 = f'Visitas_{año_3}'
+    # Mostrar información de filtrado
+    if len(df_mostrar) < len(df_perdidos):
+        st.info(f"📊 Mostrando **{len(df_mostrar)}** de **{len(df_perdidos)}** clientes")
+    else:
+        st.info(f"📊 Mostrando **{len(df_perdidos)}** clientes")
 
-                if col_año1 in tabla_final.columns and col_año2 in tabla_final.columns:
-                    clientes_año1_año2 = len(tabla_final[(tabla_final[col_año1] > 0) & (tabla_final[col_año2] > 0)])
+    # Mostrar tabla paginada (solo la página visible se envía al navegador)
+    tabla_paginada(df_mostrar, indice_busqueda, key='tabla_perdidos')
 
-                if col_año2 in tabla_final.columns and col_año3 in tabla_final.columns:
-                    clientes_año2_año3 = len(tabla_final[(tabla_final[col_año2] > 0) & (tabla_final[col_año3] > 0)])
+    descargas_clientes_perdidos(data, df_mostrar, filtro_productos)
 
-                if col_año1 in tabla_final.columns and col_año3 in tabla_final.columns:
-                    clientes_año1_año3 = len(tabla_final[(tabla_final[col_año1] > 0) & (tabla_final[col_año3] > 0)])
+def descargas_clientes_perdidos(data, df_mostrar, filtro_productos):
+    """
+    Descargas del listado de clientes perdidos. Los archivos se preparan al pulsar el
+    botón, en lugar de reconstruirlos en cada ejecución; si el filtro de productos cambia
+    después, los archivos preparados con el filtro anterior dejan de ofrecerse.
+    """
+    año_actual = data['año_actual']
 
-                if all(col in tabla_final.columns for col in [col_año1, col_año2, col_año3]):
-                    clientes_tres_años = len(tabla_final[(tabla_final[col_año1] > 0) &
-                                                          (tabla_final[col_año2] > 0) &
-                                                          (tabla_final[col_año3] > 0)])
+    # Botón de descarga
+    st.markdown("---")
+    st.subheader("💾 Descargar Listado")
+
+    if st.button("⚙️ Preparar descargas con el filtro actual", key='btn_preparar_descargas'):
+        # Excel y CSV (con datos filtrados)
+        output = io.BytesIO()
+        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+            df_mostrar.to_excel(writer, sheet_name='Clientes No Regresaron', index=False)
+
+        st.session_state['descargas_perdidos'] = {
+            'filtro': list(filtro_productos),
+            'clientes': len(df_mostrar),
+            'excel': output.getvalue(),
+            'csv': df_mostrar.to_csv(index=False, encoding='utf-8-sig')
+        }
 
-                total_clientes_año1 = clientes_por_año.get(str(año_1), 0)
+    descargas = st.session_state.get('descargas_perdidos')
+    if descargas is not None and descargas['filtro'] != list(filtro_productos):
+        st.warning("⚠️ El filtro de productos cambió desde que se prepararon las descargas. Vuelve a prepararlas.")
+    elif descargas is not None:
+        col1, col2 = st.columns(2)
 
-                categorias = [f'{año_2} a {año_1}', f'{año_3} a {año_2}', f'{año_3} a {año_1}', 'Los 3 años']
-                valores = [clientes_año1_año2, clientes_año2_año3, clientes_año1_año3, clientes_tres_años]
+        with col1:
+            st.download_button(
+                label=f"📥 Descargar Excel ({descargas['clientes']} clientes)",
+                data=descargas['excel'],
+                file_name=f"clientes_no_regresaron_{año_actual}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
 
-                if total_clientes_año1 > 0:
-                    porcentajes = [(v / total_clientes_año1) * 100 for v in valores]
-                else:
-                    porcentajes = [0, 0, 0, 0]
-
-                # Mostrar métricas principales
-                st.markdown("---")
-                st.header("📈 Métricas Principales")
-
-                col1, col2, col3, col4 = st.columns(4)
-                with col1:
-                    st.metric("Total Clientes Únicos", len(tabla_final))
-                with col2:
-                    st.metric(f"Clientes {año_3}", clientes_por_año.get(str(año_3), 0))
-                with col3:
-                    st.metric(f"Clientes {año_2}", clientes_por_año.get(str(año_2), 0))
-                with col4:
-                    st.metric(f"Clientes {año_1}", clientes_por_año.get(str(año_1), 0))
-
-                # GRÁFICAS
-                st.markdown("---")
-                st.header("📊 Gráficas de Análisis")
-
-                # Gráfica 1
-                st.subheader("Gráfica 1: Total de clientes por año")
-                fig1, ax1 = plt.subplots(figsize=(10, 6))
-                años_labels = list(clientes_por_año.keys())
-                valores_años = list(clientes_por_año.values())
-                colores_años = ['#f39c12', '#16a085', '#8e44ad']
-
-                barras = ax1.bar(años_labels, valores_años, color=colores_años[:len(años_labels)],
-                                 edgecolor='black', linewidth=1.5, width=0.6)
-
-                for barra, valor in zip(barras, valores_años):
-                    altura = barra.get_height()
-                    ax1.text(barra.get_x() + barra.get_width()/2., altura,
-                            f'{int(valor)}', ha='center', va='bottom', fontsize=13, fontweight='bold')
-
-                ax1.set_title('Gráfica 1: Total de clientes por año', fontsize=15, fontweight='bold', pad=20)
-                ax1.set_ylabel('Número de Clientes', fontsize=12)
-                ax1.set_xlabel('Año', fontsize=12)
-                ax1.grid(axis='y', alpha=0.3, linestyle='--')
-                plt.tight_layout()
-                st.pyplot(fig1)
-
-                # Gráfica 2
-                st.subheader("Gráfica 2: Cantidad de recompra en combinaciones por años")
-                fig2, ax2 = plt.subplots(figsize=(10, 6))
-                colores = ['#3498db', '#2ecc71', '#e74c3c', '#9b59b6']
-
-                barras = ax2.bar(categorias, valores, color=colores, edgecolor='black', linewidth=1.5)
-
-                for barra, valor in zip(barras, valores):
-                    altura = barra.get_height()
-                    ax2.text(barra.get_x() + barra.get_width()/2., altura,
-                            f'{int(valor)}', ha='center', va='bottom', fontsize=12, fontweight='bold')
-
-                ax2.set_title('Gráfica 2: Cantidad de recompra en combinaciones por años',
-                             fontsize=15, fontweight='bold', pad=20)
-                ax2.set_ylabel('Número de Clientes', fontsize=12)
-                ax2.grid(axis='y', alpha=0.3, linestyle='--')
-                plt.xticks(rotation=15, ha='right')
-                plt.tight_layout()
-                st.pyplot(fig2)
-
-                # Gráfica 3
-                st.subheader(f"Gráfica 3: Porcentaje de recompra en relación a clientes {año_1}")
-                fig3, ax3 = plt.subplots(figsize=(10, 6))
-
-                barras = ax3.bar(categorias, porcentajes, color=colores, edgecolor='black', linewidth=1.5)
-
-                for barra, porcentaje in zip(barras, porcentajes):
-                    altura = barra.get_height()
-                    ax3.text(barra.get_x() + barra.get_width()/2., altura,
-                            f'{porcentaje:.1f}%', ha='center', va='bottom', fontsize=12, fontweight='bold')
-
-                ax3.set_title(f'Gráfica 3: Porcentaje de recompra en relación a cantidad de clientes {año_1}',
-                             fontsize=15, fontweight='bold', pad=20)
-                ax3.set_ylabel('Porcentaje (%)', fontsize=12)
-                ax3.grid(axis='y', alpha=0.3, linestyle='--')
-                plt.xticks(rotation=15, ha='right')
-                ax3.set_ylim(0, max(porcentajes) * 1.15 if max(porcentajes) > 0 else 100)
-                plt.tight_layout()
-                st.pyplot(fig3)
-
-                # DESCARGAS
-                st.markdown("---")
-                st.header("💾 Descargar Resultados")
-
-                col1, col2 = st.columns(2)
-
-                with col1:
-                    # Excel
-                    output = io.BytesIO()
-                    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                        stats_generales = pd.DataFrame({
-                            'Métrica': ['Total de clientes únicos', 'Años analizados'],
-                            'Valor': [len(tabla_final), ', '.join([col.replace('Visitas_', '') for col in columnas_visitas])]
-                        })
-                        stats_generales.to_excel(writer, sheet_name='Estadísticas Generales', index=False)
-
-                        clientes_año_df = pd.DataFrame({
-                            'Año': list(clientes_por_año.keys()),
-                            'Total de Clientes': list(clientes_por_año.values())
-                        })
-                        clientes_año_df.to_excel(writer, sheet_name='Clientes por Año', index=False)
-
-                        retencion_df = pd.DataFrame({
-                            'Combinación de Años': categorias,
-                            'Cantidad de Clientes': valores
-                        })
-                        retencion_df.to_excel(writer, sheet_name='Retención de Clientes', index=False)
-
-                        porcentajes_df = pd.DataFrame({
-                            'Combinación de Años': categorias,
-                            'Cantidad de Clientes': valores,
-                            f'Porcentaje respecto a {año_1}': [f"{p:.2f}%" for p in porcentajes]
-                        })
-                        porcentajes_df.to_excel(writer, sheet_name='Resumen de Porcentajes', index=False)
-
-                        tabla_final.to_excel(writer, sheet_name='Datos Completos', index=False)
-
-                    output.seek(0)
-                    st.download_button(
-                        label="📥 Descargar Excel Completo",
-                        data=output,
-                        file_name="analisis_completo_clientes.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                    )
+        with col2:
+            st.download_button(
+                label=f"📥 Descargar CSV ({descargas['clientes']} clientes)",
+                data=descargas['csv'],
+                file_name=f"clientes_no_regresaron_{año_actual}.csv",
+                mime="text/csv"
+            )
 
-                with col2:
-                    # CSV
-                    csv = tabla_final.to_csv(index=False, encoding='utf-8-sig')
-                    st.download_button(
-                        label="📥 Descargar CSV de Datos",
-                        data=csv,
-                        file_name="frecuencia_clientes.csv",
-                        mime="text/csv"
-                    )
+    # Exportación por partición en segundo plano
+    st.markdown("---")
+    st.subheader("📦 Exportar por CDS y Familia de Producto")
+    st.caption("Genera un ZIP con un CSV y un Excel por cada combinación de CDS y familia. "
+               "Se procesa en segundo plano: puedes seguir usando la aplicación mientras tanto.")
+
+    exportacion = st.session_state.get('exportacion_particiones')
+
+    if st.button("📦 Generar exportación por partición", key='btn_exportar_particiones',
+                 disabled=exportacion is not None and exportacion['estado'] == 'en_curso'):
+        # Liberar los archivos de la exportación anterior y los abandonados por otras sesiones
+        descartar_exportacion()
+        barrer_exportaciones_vencidas()
+        exportacion = {
+            'estado': 'en_curso',
+            'progreso': 0.0,
+            'mensaje': 'En cola...',
+            'archivo': None,
+            'filtro': list(filtro_productos)
+        }
+        st.session_state['exportacion_particiones'] = exportacion
+        obtener_ejecutor_exportaciones().submit(
+            exportar_particiones,
+            df_mostrar,
+            data['particiones_perdidos'],
+            data['columna_id'],
+            data['columna_departamento'],
+            data['columna_familia'],
+            data['año_actual'],
+            exportacion
+        )
 
-                st.success("✅ Análisis completado exitosamente!")
+    if exportacion is not None:
+        if exportacion['estado'] == 'en_curso':
+            seguimiento_exportacion()
+        elif exportacion['filtro'] != list(filtro_productos):
+            # La exportación ya no se ofrece: sus datos de contacto no deben quedar en disco
+            descartar_exportacion()
+            st.warning("⚠️ El filtro de productos cambió desde que se generó la exportación. Vuelve a generarla.")
+        elif exportacion['estado'] == 'descargado':
+            st.success("✅ ZIP descargado. Los archivos temporales se borraron; genera la exportación de nuevo para volver a descargarlo.")
+        elif exportacion['estado'] == 'terminado' and not os.path.exists(exportacion['archivo']):
+            st.warning("⚠️ La exportación venció. Vuelve a generarla.")
+        elif exportacion['estado'] == 'terminado':
+            st.download_button(
+                label=f"📥 Descargar ZIP ({exportacion['particiones']} particiones)",
+                data=leer_y_borrar_exportacion(exportacion),
+                file_name=os.path.basename(exportacion['archivo']),
+                mime="application/zip",
+                key='descarga_particiones'
+            )
+        else:
+            st.error(f"❌ Error en la exportación: {exportacion['mensaje']}")
 
-def fidelizacion_clientes(df, año_actual):
+def calcular_fidelizacion(df, año_actual, filtros, trabajo):
     """
-    Función que identifica clientes que NO han regresado en el año actual
-    pero que sí compraron en años anteriores.
-    Incluye filtros y muestra análisis detallado por año.
+    Procesamiento de fidelización (sin interfaz): clientes de los años anteriores que
+    regresaron o no en el año actual y el listado de clientes perdidos.
+    Se ejecuta en segundo plano.
     """
     años_anteriores = [año_actual - 1, año_actual - 2, año_actual - 3]
     año_1, año_2, año_3 = años_anteriores[0], años_anteriores[1], años_anteriores[2]
 
-    st.header("🔄 Fidelización de Clientes")
-    st.info(f"📅 Año actual: **{año_actual}** | Años anteriores: **{año_1}, {año_2}, {año_3}**")
+    # Procesar datos
+    columna_id = df.columns[3]  # Código de cliente
+    columna_nombre = df.columns[4]  # Nombre
+    columna_correo = df.columns[5]  # Correo
+    columna_tel1 = df.columns[6]  # Teléfono 1
+    columna_tel2 = df.columns[7]  # Teléfono 2
+    columna_placa = df.columns[8]  # Placa
+    columna_producto = df.columns[16]  # Columna Q [16]
+    columna_departamento = df.columns[13]  # Columna N
+    columna_familia = df.columns[18]  # Columna S
+
+    # Aplicar filtros y descartar registros sin código de cliente en una sola pasada
+    trabajo.avanzar('Aplicando filtros...', 0.1)
+    df_limpio = aplicar_filtros(df, filtros, columnas=[3, 4, 5, 6, 7, 8, 13, 16, 18], sin_vacios=[columna_id])
+
+    if len(df_limpio) == 0:
+        return {'registros': 0}
+
+    trabajo.avanzar('Identificando clientes por año...', 0.3)
+
+    # Clientes del año actual
+    clientes_año_actual = set(df_limpio[df_limpio['Año'] == año_actual][columna_id].unique())
+
+    # Clientes de cada año anterior
+    clientes_año_1 = set(df_limpio[df_limpio['Año'] == año_1][columna_id].unique())
+    clientes_año_2 = set(df_limpio[df_limpio['Año'] == año_2][columna_id].unique())
+    clientes_año_3 = set(df_limpio[df_limpio['Año'] == año_3][columna_id].unique())
+
+    # Clientes de años anteriores (todos)
+    clientes_años_anteriores = clientes_año_1 | clientes_año_2 | clientes_año_3
+
+    # Clientes de cada año anterior que han regresado al año actual
+    clientes_año_1_regresaron = clientes_año_1 & clientes_año_actual
+    clientes_año_2_regresaron = clientes_año_2 & clientes_año_actual
+    clientes_año_3_regresaron = clientes_año_3 & clientes_año_actual
+
+    # Clientes que NO han regresado en el año actual
+    clientes_no_regresaron = clientes_años_anteriores - clientes_año_actual
+
+    # Clientes que SÍ regresaron
+    clientes_regresaron = clientes_años_anteriores & clientes_año_actual
+
+    # Total de clientes únicos en el año actual
+    total_clientes_año_actual = len(clientes_año_actual)
+
+    # Fecha de actualización
+    columna_fecha_completa = df.columns[2]  # Columna C [2]
+    fecha_maxima = df[columna_fecha_completa].max()
+
+    # Listado de clientes perdidos: una pasada agrupada por cliente
+    trabajo.avanzar('Construyendo listado de clientes perdidos...', 0.6)
+    filas_perdidos = df_limpio[df_limpio[columna_id].isin(clientes_no_regresaron)]
+    df_perdidos = construir_listado_perdidos(
+        filas_perdidos,
+        columna_id, columna_nombre, columna_correo, columna_tel1, columna_tel2,
+        columna_placa, columna_producto
+    )
+
+    # Combinaciones cliente / CDS / familia, para la exportación por partición
+    particiones_perdidos = filas_perdidos[[columna_id, columna_departamento, columna_familia]].drop_duplicates()
+
+    trabajo.avanzar('Preparando búsqueda...', 0.9)
+    indice_busqueda = construir_indice_busqueda(df_perdidos)
+    conteo_productos = contar_productos(df_perdidos)
+
+    return {
+        'registros': len(df_limpio),
+        'df_perdidos': df_perdidos,
+        'particiones_perdidos': particiones_perdidos,
+        'indice_busqueda': indice_busqueda,
+        'conteo_productos': conteo_productos,
+        'clientes_no_regresaron': clientes_no_regresaron,
+        'clientes_regresaron': clientes_regresaron,
+        'clientes_años_anteriores': clientes_años_anteriores,
+        'total_clientes_año_actual': total_clientes_año_actual,
+        'clientes_año_1_regresaron': clientes_año_1_regresaron,
+        'clientes_año_2_regresaron': clientes_año_2_regresaron,
+        'clientes_año_3_regresaron': clientes_año_3_regresaron,
+        'año_actual': año_actual,
+        'año_1': año_1,
+        'año_2': año_2,
+        'año_3': año_3,
+        'columna_id': columna_id,
+        'columna_nombre': columna_nombre,
+        'columna_correo': columna_correo,
+        'columna_tel1': columna_tel1,
+        'columna_tel2': columna_tel2,
+        'columna_placa': columna_placa,
+        'columna_departamento': columna_departamento,
+        'columna_familia': columna_familia,
+        'fecha_maxima': fecha_maxima
+    }
+
+def contar_productos(df_perdidos):
+    """Clientes perdidos por producto, ordenados por nombre de producto (una sola pasada vectorizada)"""
+    productos = df_perdidos['Productos Comprados']
+    productos = productos[productos != 'Sin datos'].str.split(',').explode().str.strip()
+    productos = productos[productos != '']
+    # Cada cliente cuenta una vez por producto
+    return productos.reset_index().drop_duplicates().iloc[:, 1].value_counts().sort_index()
+
+def construir_listado_perdidos(df_perdidos_filas, columna_id, columna_nombre, columna_correo,
+                               columna_tel1, columna_tel2, columna_placa, columna_producto):
+    """
+    Arma el listado de clientes que no regresaron a partir de sus registros.
+    Datos de contacto del primer registro de cada cliente; años, productos y placas únicos.
+    Los valores únicos se ordenan una sola vez y se unen por tramos, sin un groupby por cliente.
+    """
+    def unir_unicos(columna):
+        # Pares únicos cliente/valor, ordenados por cliente y valor, y unidos en cada tramo
+        pares = df_perdidos_filas[[columna_id, columna]].dropna().drop_duplicates()
+        if len(pares) == 0:
+            return pd.Series(dtype=object)
+        codigos_cliente, clientes = pd.factorize(pares[columna_id])
+        codigos_valor, valores = pd.factorize(pares[columna], sort=True)
+        orden = np.lexsort((codigos_valor, codigos_cliente))
+        textos = valores.astype(str).to_numpy(dtype=object)[codigos_valor[orden]]
+        cortes = np.flatnonzero(np.diff(codigos_cliente[orden])) + 1
+        return pd.Series([', '.join(tramo) for tramo in np.split(textos, cortes)], index=clientes)
+
+    primeros = df_perdidos_filas.drop_duplicates(subset=columna_id, keep='first').set_index(columna_id)
+
+    años_compra = unir_unicos('Año')
+    productos = unir_unicos(columna_producto).reindex(primeros.index).fillna('Sin datos')
+    placas = unir_unicos(columna_placa).reindex(primeros.index).fillna('Sin datos')
+
+    return pd.DataFrame({
+        'Código Cliente': primeros.index,
+        'Nombre': primeros[columna_nombre].to_numpy(),
+        'Productos Comprados': productos.to_numpy(),
+        'Correo': primeros[columna_correo].to_numpy(),
+        'Teléfono 1': primeros[columna_tel1].to_numpy(),
+        'Teléfono 2': primeros[columna_tel2].to_numpy(),
+        'Placas': placas.to_numpy(),
+        'Años en que compró': años_compra.reindex(primeros.index).to_numpy()
+    })
+
+# Segmentos RFM: (nombre, descripción, color), en el orden en que se muestran
+SEGMENTOS_RFM = [
+    ('Campeones', 'Compraron hace poco y vienen seguido', '#27ae60'),
+    ('Leales', 'Vienen seguido, aunque no tan recientemente', '#2ecc71'),
+    ('Potenciales leales', 'Recientes con frecuencia media', '#3498db'),
+    ('Nuevos', 'Recientes con pocas visitas', '#1abc9c'),
+    ('Necesitan atención', 'Recencia y frecuencia intermedias', '#f1c40f'),
+    ('En riesgo', 'Venían seguido pero hace tiempo no compran', '#e67e22'),
+    ('No se pueden perder', 'Los más frecuentes, con la compra más lejana', '#e74c3c'),
+    ('Hibernando', 'Pocas visitas y hace mucho tiempo', '#95a5a6'),
+]
+
+def segmentacion_rfm(df, año_actual):
+    """
+    Segmentación RFM de clientes: recencia (última compra), frecuencia (visitas) y
+    amplitud (productos distintos), con segmentos accionables.
+    Usa los mismos filtros que las demás funciones y corre como trabajo en segundo plano.
+    """
+    st.header("🎯 Segmentación RFM de Clientes")
+    st.info(f"📅 Compras de **{año_actual - 3}** a **{año_actual}**, con fecha de referencia al cierre de {año_actual} "
+            f"(o a la última fecha con datos)")
 
     # SECCIÓN DE FILTROS (igual que analisis_recompra)
     st.header("🔍 Filtros de Análisis")
 
-    col1, col2, col3, col4 = st.columns(4)
+    filtros = seccion_filtros(df, sufijo='_rfm')
 
-    # Obtener nombres de columnas
-    columna_tipo_asesor = df.columns[11]  # Columna L
-    columna_departamento = df.columns[13]  # Columna N
-    columna_familia = df.columns[18]  # Columna S
-    columna_area = df.columns[22]  # Columna W
+    st.markdown("---")
 
-    with col1:
-        st.subheader("👤 Asesor")
-        valores_asesor = ['Todos'] + sorted(df[columna_tipo_asesor].dropna().unique().tolist())
-        filtro_asesor = st.multiselect(
-            "Selecciona tipo(s) de asesor:",
-            valores_asesor,
-            default=['Todos'],
-            key='asesor_fidelizacion'
-        )
+    # Un cambio de filtros o de año cancela el análisis que estuviera en curso
+    clave = ('rfm', df.attrs.get('huella'), año_actual, filtros)
+    trabajo = vigilar_trabajo('trabajo_rfm', clave)
 
-    with col2:
-        st.subheader("🏢 CDS")
-        valores_depto = ['Todos'] + sorted(df[columna_departamento].dropna().unique().tolist())
-        filtro_depto = st.multiselect(
-            "Selecciona departamento(s):",
-            valores_depto,
-            default=['Todos'],
-            key='depto_fidelizacion'
-        )
+    if st.button("🎯 SEGMENTAR CLIENTES", type="primary", use_container_width=True, key='btn_rfm'):
+        trabajo = iniciar_trabajo('trabajo_rfm', clave, calcular_rfm, df, año_actual, filtros)
 
-    with col3:
-        st.subheader("🛞 Producto")
-        valores_familia = ['Todos'] + sorted(df[columna_familia].dropna().unique().tolist())
-        filtro_familia = st.multiselect(
-            "Selecciona familia(s):",
-            valores_familia,
-            default=['Todos'],
-            key='familia_fidelizacion'
-        )
+    if trabajo is None:
+        return
 
-    with col4:
-        st.subheader("📍 Área")
-        valores_area = ['Todos'] + sorted(df[columna_area].dropna().unique().tolist())
-        filtro_area = st.multiselect(
-            "Selecciona área(s):",
-            valores_area,
-            default=['Todos'],
-            key='area_fidelizacion'
-        )
+    if not trabajo.futuro.done():
+        seguimiento_trabajo('trabajo_rfm')
+        return
 
-    st.markdown("---")
+    if trabajo.futuro.cancelled() or trabajo.cancelado.is_set():
+        del st.session_state['trabajo_rfm']
+        return
 
-    # Botón para ejecutar análisis
-    if st.button("🔍 ANALIZAR FIDELIZACIÓN", type="primary", use_container_width=True, key='btn_fidelizacion'):
+    error = trabajo.futuro.exception()
+    if error is not None:
+        del st.session_state['trabajo_rfm']
+        st.error(f"❌ Error al procesar los datos: {error}")
+        return
 
-        with st.spinner('Procesando datos...'):
-
-            # Aplicar filtros
-            df_filtrado = df.copy()
-
-            if 'Todos' not in filtro_asesor:
-                df_filtrado = df_filtrado[df_filtrado[columna_tipo_asesor].isin(filtro_asesor)]
-
-            if 'Todos' not in filtro_depto:
-                df_filtrado = df_filtrado[df_filtrado[columna_departamento].isin(filtro_depto)]
-
-            if 'Todos' not in filtro_familia:
-                df_filtrado = df_filtrado[df_filtrado[columna_familia].isin(filtro_familia)]
-
-            if 'Todos' not in filtro_area:
-                df_filtrado = df_filtrado[df_filtrado[columna_area].isin(filtro_area)]
-
-            # Procesar datos
-            columna_id = df_filtrado.columns[3]  # Código de cliente
-            columna_fecha = df_filtrado.columns[2]  # Fecha
-            columna_nombre = df_filtrado.columns[4]  # Nombre
-            columna_correo = df_filtrado.columns[5]  # Correo
-            columna_tel1 = df_filtrado.columns[6]  # Teléfono 1
-            columna_tel2 = df_filtrado.columns[7]  # Teléfono 2
-            columna_placa = df_filtrado.columns[8]  # Placa
-
-            df_temp = df_filtrado.copy()
-            df_temp['Año'] = df_temp[columna_fecha].dt.year
-
-            df_limpio = df_temp.dropna(subset=[columna_id])
-
-            # Verificar si hay datos después del filtro
-            if len(df_limpio) == 0:
-                st.error("❌ No hay datos que coincidan con los filtros seleccionados. Por favor, ajusta tus criterios.")
-                # Limpiar session_state si no hay datos
-                if 'fidelizacion_data' in st.session_state:
-                    del st.session_state['fidelizacion_data']
-            else:
-                st.success(f"✅ Se encontraron {len(df_limpio)} registros con los filtros aplicados")
-
-                # Clientes del año actual
-                clientes_año_actual = set(df_limpio[df_limpio['Año'] == año_actual][columna_id].unique())
-
-                # Clientes de cada año anterior
-                clientes_año_1 = set(df_limpio[df_limpio['Año'] == año_1][columna_id].unique())
-                clientes_año_2 = set(df_limpio[df_limpio['Año'] == año_2][columna_id].unique())
-                clientes_año_3 = set(df_limpio[df_limpio['Año'] == año_3][columna_id].unique())
-
-                # Clientes de años anteriores (todos)
-                clientes_años_anteriores = clientes_año_1 | clientes_año_2 | clientes_año_3
-
-                # Clientes de cada año anterior que han regresado al año actual
-                clientes_año_1_regresaron = clientes_año_1 & clientes_año_actual
-                clientes_año_2_regresaron = clientes_año_2 & clientes_año_actual
-                clientes_año_3_regresaron = clientes_año_3 & clientes_año_actual
-
-                # Clientes que NO han regresado en el año actual
-                clientes_no_regresaron = clientes_años_anteriores - clientes_año_actual
-
-                # Clientes que SÍ regresaron
-                clientes_regresaron = clientes_años_anteriores & clientes_año_actual
-
-                # Total de clientes únicos en el año actual
-                total_clientes_año_actual = len(clientes_año_actual)
-
-                # Fecha de actualización
-                columna_fecha_completa = df.columns[2]  # Columna C [2]
-                fecha_maxima = df[columna_fecha_completa].max()
-
-                # GUARDAR TODOS LOS DATOS EN SESSION_STATE
-                st.session_state['fidelizacion_data'] = {
-                    'df_limpio': df_limpio,
-                    'clientes_no_regresaron': clientes_no_regresaron,
-                    'clientes_regresaron': clientes_regresaron,
-                    'clientes_años_anteriores': clientes_años_anteriores,
-                    'total_clientes_año_actual': total_clientes_año_actual,
-                    'clientes_año_1_regresaron': clientes_año_1_regresaron,
-                    'clientes_año_2_regresaron': clientes_año_2_regresaron,
-                    'clientes_año_3_regresaron': clientes_año_3_regresaron,
-                    'año_actual': año_actual,
-                    'año_1': año_1,
-                    'año_2': año_2,
-                    'año_3': año_3,
-                    'columna_id': columna_id,
-                    'columna_nombre': columna_nombre,
-                    'columna_correo': columna_correo,
-                    'columna_tel1': columna_tel1,
-                    'columna_tel2': columna_tel2,
-                    'columna_placa': columna_placa,
-                    'fecha_maxima': fecha_maxima
-                }
+    resultado = trabajo.futuro.result()
 
-    # RENDERIZAR RESULTADOS SI EXISTEN EN SESSION_STATE
-    if 'fidelizacion_data' in st.session_state:
-        data = st.session_state['fidelizacion_data']
-
-        # Extraer datos de session_state
-        df_limpio = data['df_limpio']
-        clientes_no_regresaron = data['clientes_no_regresaron']
-        clientes_regresaron = data['clientes_regresaron']
-        clientes_años_anteriores = data['clientes_años_anteriores']
-        total_clientes_año_actual = data['total_clientes_año_actual']
-        clientes_año_1_regresaron = data['clientes_año_1_regresaron']
-        clientes_año_2_regresaron = data['clientes_año_2_regresaron']
-        clientes_año_3_regresaron = data['clientes_año_3_regresaron']
-        año_actual = data['año_actual']
-        año_1 = data['año_1']
-        año_2 = data['año_2']
-        año_3 = data['año_3']
-        columna_id = data['columna_id']
-        columna_nombre = data['columna_nombre']
-        columna_correo = data['columna_correo']
-        columna_tel1 = data['columna_tel1']
-        columna_tel2 = data['columna_tel2']
-        columna_placa = data['columna_placa']
-        fecha_maxima = data['fecha_maxima']
-
-        # Mostrar métricas principales
-        st.markdown("---")
-        st.header("📊 Resultados de Fidelización")
+    if resultado['registros'] == 0:
+        st.error("❌ No hay datos que coincidan con los filtros seleccionados. Por favor, ajusta tus criterios.")
+    else:
+        st.success(f"✅ Se encontraron {resultado['registros']} registros con los filtros aplicados")
+        mostrar_resultados_rfm(resultado, clave)
 
-        col1, col2, col3, col4 = st.columns(4)
-        with col1:
-            st.metric("Clientes Años Anteriores", len(clientes_años_anteriores))
-        with col2:
-            st.metric("✅ Clientes que Regresaron", len(clientes_regresaron))
-        with col3:
-            st.metric("❌ Clientes que NO Regresaron", len(clientes_no_regresaron))
-        with col4:
-            st.metric(f"Clientes {año_actual}", total_clientes_año_actual)
-
-        # Mostrar última fecha de actualización
-        meses = {
-            1: 'enero', 2: 'febrero', 3: 'marzo', 4: 'abril',
-            5: 'mayo', 6: 'junio', 7: 'julio', 8: 'agosto',
-            9: 'septiembre', 10: 'octubre', 11: 'noviembre', 12: 'diciembre'
+def calcular_rfm(df, año_actual, filtros, trabajo):
+    """
+    Procesamiento de la segmentación RFM (sin interfaz), en unas pocas pasadas agrupadas
+    por cliente sobre las columnas de fecha, cliente y producto. Se ejecuta en segundo plano.
+    Los segmentos dependen de R y F; A se calcula y se informa, pero no los define.
+    """
+    columna_fecha = df.columns[2]  # Fecha
+    columna_id = df.columns[3]  # Código de cliente
+    columna_nombre = df.columns[4]  # Nombre
+    columna_correo = df.columns[5]  # Correo
+    columna_tel1 = df.columns[6]  # Teléfono 1
+    columna_tel2 = df.columns[7]  # Teléfono 2
+    columna_producto = df.columns[16]  # Columna Q [16]
+
+    # Aplicar filtros y ventana (los 3 años anteriores y el año de referencia) en una sola pasada
+    trabajo.avanzar('Aplicando filtros...', 0.1)
+    df_ventana = aplicar_filtros(
+        df, filtros, columnas=[2, 3, 4, 5, 6, 7, 16],
+        años=range(año_actual - 3, año_actual + 1), sin_vacios=[columna_id]
+    )
+
+    if len(df_ventana) == 0:
+        return {'registros': 0}
+
+    fecha_referencia = min(df_ventana[columna_fecha].max(), pd.Timestamp(year=año_actual, month=12, day=31))
+
+    # Una pasada agrupada: última compra, visitas y productos distintos por cliente
+    trabajo.avanzar('Calculando recencia, frecuencia y amplitud...', 0.4)
+    por_cliente = df_ventana.groupby(columna_id, sort=False).agg(
+        ultima_compra=(columna_fecha, 'max'),
+        visitas=(columna_fecha, 'size'),
+        productos=(columna_producto, 'nunique')
+    )
+    contacto = df_ventana.drop_duplicates(subset=columna_id, keep='first').set_index(columna_id)
+    contacto = contacto.reindex(por_cliente.index)
+
+    # Puntajes de 1 a 5 por quintiles (los empates reciben el mismo puntaje)
+    trabajo.avanzar('Asignando puntajes y segmentos...', 0.7)
+    dias = (fecha_referencia - por_cliente['ultima_compra']).dt.days
+    puntaje_r = puntaje_quintil(-dias)
+    # Visitas y productos tienen muchos empates abajo (la mayoría compra una vez): los
+    # empates toman el rango más bajo, así 1 visita o 1 producto siempre da puntaje 1
+    puntaje_f = puntaje_quintil(por_cliente['visitas'], empates='min')
+    puntaje_a = puntaje_quintil(por_cliente['productos'], empates='min')
+
+    r = puntaje_r.to_numpy()
+    f = puntaje_f.to_numpy()
+    nombres_segmentos = [nombre for nombre, _, _ in SEGMENTOS_RFM]
+    segmento = np.select(
+        [
+            (r >= 4) & (f >= 4),
+            (r >= 3) & (f >= 4),
+            (r >= 4) & (f >= 2),
+            (r >= 4),
+            (r == 3),
+            (r == 2) & (f >= 3),
+            (r == 1) & (f >= 4),
+            (r <= 2),
+        ],
+        nombres_segmentos,
+        default='Necesitan atención'
+    )
+
+    df_rfm = pd.DataFrame({
+        'Código Cliente': por_cliente.index,
+        'Nombre': contacto[columna_nombre].to_numpy(),
+        'Correo': contacto[columna_correo].to_numpy(),
+        'Teléfono 1': contacto[columna_tel1].to_numpy(),
+        'Teléfono 2': contacto[columna_tel2].to_numpy(),
+        'Última compra': por_cliente['ultima_compra'].dt.date.to_numpy(),
+        'Días desde última compra': dias.to_numpy(),
+        'Visitas': por_cliente['visitas'].to_numpy(),
+        'Productos distintos': por_cliente['productos'].to_numpy(),
+        'R': r,
+        'F': f,
+        'A': puntaje_a.to_numpy(),
+        'Segmento': segmento
+    })
+    df_rfm.insert(df_rfm.columns.get_loc('Segmento'), 'Puntaje RFM',
+                  df_rfm['R'].astype(str) + df_rfm['F'].astype(str) + df_rfm['A'].astype(str))
+
+    resumen = df_rfm.groupby('Segmento').agg(
+        Clientes=('Código Cliente', 'size'),
+        Dias_promedio=('Días desde última compra', 'mean'),
+        Visitas_promedio=('Visitas', 'mean'),
+        Productos_promedio=('Productos distintos', 'mean')
+    ).reindex(nombres_segmentos, fill_value=0).reset_index()
+    resumen.columns = ['Segmento', 'Clientes', 'Días promedio desde última compra',
+                       'Visitas promedio', 'Productos distintos promedio']
+
+    trabajo.avanzar('Preparando búsqueda...', 0.9)
+    indice_busqueda = construir_indice_busqueda(df_rfm)
+
+    return {
+        'registros': len(df_ventana),
+        'df_rfm': df_rfm,
+        'resumen': resumen,
+        'indice_busqueda': indice_busqueda,
+        'fecha_referencia': fecha_referencia,
+        'año_actual': año_actual
+    }
+
+def puntaje_quintil(valores, empates='average'):
+    """
+    Puntaje de 1 a 5 según el quintil de cada valor (mayor valor, mayor puntaje).
+    `empates` es el método de rank para valores iguales; con 'min' el valor más bajo
+    recibe siempre puntaje 1, aunque lo comparta la mayoría de los clientes.
+    """
+    percentil = valores.rank(method=empates, pct=True)
+    return np.ceil(percentil * 5).clip(1, 5).astype(int)
+
+@st.fragment
+def mostrar_resultados_rfm(resultado, clave):
+    """
+    Muestra el resumen por segmento, la gráfica, el listado filtrable y las descargas.
+    Es un fragmento: sus interacciones no vuelven a ejecutar el resto de la página.
+    """
+    df_rfm = resultado['df_rfm']
+    resumen = resultado['resumen']
+    fecha_referencia = resultado['fecha_referencia']
+
+    st.markdown("---")
+    st.header("📊 Segmentos de Clientes")
+    st.caption(f"Fecha de referencia para la recencia: {fecha_referencia:%d/%m/%Y}. "
+               "R = recencia, F = frecuencia (visitas), A = amplitud (productos distintos); puntajes de 1 a 5. "
+               "Los segmentos se asignan solo con R y F; A sirve para distinguir, dentro de cada segmento, "
+               "a quienes compran más variedad de productos.")
+
+    col1, col2, col3, col4 = st.columns(4)
+    for posicion, (nombre, descripcion, _) in enumerate(SEGMENTOS_RFM):
+        with [col1, col2, col3, col4][posicion % 4]:
+            clientes = int(resumen.loc[resumen['Segmento'] == nombre, 'Clientes'].iloc[0])
+            st.metric(nombre, clientes, help=descripcion)
+
+    # Gráfica de tamaño de segmentos
+    fig, ax = plt.subplots(figsize=(10, 6))
+    colores = [color for _, _, color in SEGMENTOS_RFM]
+    barras = ax.barh(resumen['Segmento'], resumen['Clientes'], color=colores, edgecolor='black', linewidth=1.5)
+
+    for barra, valor in zip(barras, resumen['Clientes']):
+        ax.text(barra.get_width(), barra.get_y() + barra.get_height()/2.,
+                f' {int(valor)}', ha='left', va='center', fontsize=12, fontweight='bold')
+
+    ax.set_title('Clientes por segmento RFM', fontsize=15, fontweight='bold', pad=20)
+    ax.set_xlabel('Número de Clientes', fontsize=12)
+    ax.invert_yaxis()
+    ax.grid(axis='x', alpha=0.3, linestyle='--')
+    plt.tight_layout()
+    st.pyplot(fig)
+    plt.close(fig)
+
+    st.dataframe(
+        resumen,
+        use_container_width=True,
+        hide_index=True,
+        column_config={
+            'Días promedio desde última compra': st.column_config.NumberColumn(format="%.0f"),
+            'Visitas promedio': st.column_config.NumberColumn(format="%.1f"),
+            'Productos distintos promedio': st.column_config.NumberColumn(format="%.1f")
         }
-        dia = fecha_maxima.day
-        mes = meses[fecha_maxima.month]
-        año = fecha_maxima.year
-        st.info(f"📅 Estos datos están actualizados al {dia} de {mes} de {año}")
+    )
 
-        # GRÁFICAS
-        st.markdown("---")
-        st.header("📈 Análisis de Retorno por Año")
+    # Listado por segmento
+    st.markdown("---")
+    st.header("📋 Listado de Clientes por Segmento")
 
-        # Gráfica 1: Cantidad de clientes de cada año anterior que regresaron
-        st.subheader(f"Gráfica 1: Clientes de cada año anterior que regresaron en {año_actual}")
+    filtro_segmentos = st.multiselect(
+        "Selecciona segmento(s):",
+        ['Todos'] + [nombre for nombre, _, _ in SEGMENTOS_RFM],
+        default=['Todos'],
+        key='filtro_segmentos'
+    )
 
-        fig1, ax1 = plt.subplots(figsize=(10, 6))
-        categorias_años = [f'Del año {año_3}', f'Del año {año_2}', f'Del año {año_1}']
-        valores_regreso = [
-            len(clientes_año_3_regresaron),
-            len(clientes_año_2_regresaron),
-            len(clientes_año_1_regresaron)
-        ]
-        colores_años = ['#f39c12', '#16a085', '#8e44ad']
-
-        barras1 = ax1.bar(categorias_años, valores_regreso, color=colores_años,
-                         edgecolor='black', linewidth=1.5, width=0.6)
-
-        for barra, valor in zip(barras1, valores_regreso):
-            altura = barra.get_height()
-            ax1.text(barra.get_x() + barra.get_width()/2., altura,
-                    f'{int(valor)}', ha='center', va='bottom', fontsize=13, fontweight='bold')
-
-        ax1.set_title(f'Clientes de cada año anterior que regresaron en {año_actual}',
-                     fontsize=15, fontweight='bold', pad=20)
-        ax1.set_ylabel('Número de Clientes', fontsize=12)
-        ax1.set_xlabel('Año de origen', fontsize=12)
-        ax1.grid(axis='y', alpha=0.3, linestyle='--')
-        plt.tight_layout()
-        st.pyplot(fig1)
-
-        # Gráfica 2: Porcentaje respecto al total del año actual
-        st.subheader(f"Gráfica 2: Porcentaje respecto a clientes únicos de {año_actual}")
-
-        fig2, ax2 = plt.subplots(figsize=(10, 6))
-
-        if total_clientes_año_actual > 0:
-            porcentajes = [
-                (len(clientes_año_3_regresaron) / total_clientes_año_actual) * 100,
-                (len(clientes_año_2_regresaron) / total_clientes_año_actual) * 100,
-                (len(clientes_año_1_regresaron) / total_clientes_año_actual) * 100
-            ]
-        else:
-            porcentajes = [0, 0, 0]
-
-        barras2 = ax2.bar(categorias_años, porcentajes, color=colores_años,
-                         edgecolor='black', linewidth=1.5, width=0.6)
-
-        for barra, porcentaje in zip(barras2, porcentajes):
-            altura = barra.get_height()
-            ax2.text(barra.get_x() + barra.get_width()/2., altura,
-                    f'{porcentaje:.1f}%', ha='center', va='bottom', fontsize=13, fontweight='bold')
-
-        ax2.set_title(f'Porcentaje de clientes de años anteriores respecto a total de {año_actual}',
-                     fontsize=15, fontweight='bold', pad=20)
-        ax2.set_ylabel('Porcentaje (%)', fontsize=12)
-        ax2.set_xlabel('Año de origen', fontsize=12)
-        ax2.grid(axis='y', alpha=0.3, linestyle='--')
-        ax2.set_ylim(0, max(porcentajes) * 1.15 if max(porcentajes) > 0 else 100)
-        plt.tight_layout()
-        st.pyplot(fig2)
-
-        # Gráfica 3: Comparación de clientes que regresaron vs no regresaron
-        st.markdown("---")
-        st.subheader("Gráfica 3: Comparación general de fidelización")
-
-        fig3, ax3 = plt.subplots(figsize=(10, 6))
-        categorias = ['Clientes que\nRegresaron', 'Clientes que\nNO Regresaron']
-        valores = [len(clientes_regresaron), len(clientes_no_regresaron)]
-        colores = ['#2ecc71', '#e74c3c']
-
-        barras3 = ax3.bar(categorias, valores, color=colores, edgecolor='black', linewidth=1.5)
-
-        for barra, valor in zip(barras3, valores):
-            altura = barra.get_height()
-            ax3.text(barra.get_x() + barra.get_width()/2., altura,
-                    f'{int(valor)}', ha='center', va='bottom', fontsize=13, fontweight='bold')
-
-        ax3.set_title(f'Comparación de Fidelización de Clientes en {año_actual}',
-                     fontsize=15, fontweight='bold', pad=20)
-        ax3.set_ylabel('Número de Clientes', fontsize=12)
-        ax3.grid(axis='y', alpha=0.3, linestyle='--')
-        plt.tight_layout()
-        st.pyplot(fig3)
-
-        # Obtener datos de clientes que no regresaron
-        if len(clientes_no_regresaron) > 0:
-            st.markdown("---")
-            st.header("📋 Listado de Clientes que NO Regresaron")
-
-            # Crear DataFrame con información de clientes perdidos
-            columna_producto = df.columns[16]  # Columna Q [16]
-            clientes_perdidos = []
-
-            for cliente_id in clientes_no_regresaron:
-                # Obtener datos del cliente (tomar el primer registro)
-                datos_cliente = df_limpio[df_limpio[columna_id] == cliente_id].iloc[0]
-
-                # Determinar en qué años compró
-                años_compra = df_limpio[df_limpio[columna_id] == cliente_id]['Año'].unique()
-                años_compra_str = ', '.join([str(año) for año in sorted(años_compra)])
-
-                # Obtener productos únicos que compró este cliente
-                productos_cliente = df_limpio[df_limpio[columna_id] == cliente_id][columna_producto].dropna().unique()
-                productos_str = ', '.join(sorted(productos_cliente)) if len(productos_cliente) > 0 else 'Sin datos'
-
-                # Obtener todas las placas únicas del cliente
-                placas_cliente = df_limpio[df_limpio[columna_id] == cliente_id][columna_placa].dropna().unique()
-                placas_str = ', '.join(sorted(placas_cliente)) if len(placas_cliente) > 0 else 'Sin datos'
-
-                clientes_perdidos.append({
-                    'Código Cliente': cliente_id,
-                    'Nombre': datos_cliente[columna_nombre],
-                    'Productos Comprados': productos_str,
-                    'Correo': datos_cliente[columna_correo],
-                    'Teléfono 1': datos_cliente[columna_tel1],
-                    'Teléfono 2': datos_cliente[columna_tel2],
-                    'Placas': placas_str,
-                    'Años en que compró': años_compra_str
-                })
-
-            df_perdidos = pd.DataFrame(clientes_perdidos)
-
-            # FILTRO POST-ANÁLISIS: Filtrar por tipo de producto
-            st.subheader("🔍 Filtrar por Tipo de Producto")
-
-            # Obtener todos los productos únicos de los clientes perdidos
-            todos_productos = []
-            for productos_str in df_perdidos['Productos Comprados']:
-                if productos_str != 'Sin datos':
-                    productos_list = [p.strip() for p in productos_str.split(',')]
-                    todos_productos.extend(productos_list)
-
-            productos_unicos = sorted(set(todos_productos))
-
-            # Crear diccionario con contador de clientes por producto
-            contador_productos = {}
-            for producto in productos_unicos:
-                count = sum(1 for p in df_perdidos['Productos Comprados'] if producto in p)
-                contador_productos[producto] = count
-
-            # Crear opciones con contadores
-            opciones_productos = ['Todos'] + [f"{prod} ({contador_productos[prod]} clientes)" for prod in productos_unicos]
-
-            filtro_productos = st.multiselect(
-                "Selecciona tipo(s) de producto (puedes escribir para buscar):",
-                opciones_productos,
-                default=['Todos'],
-                help="Filtra clientes según los productos que compraron. Usa la búsqueda escribiendo parte del nombre."
-            )
+    df_mostrar = df_rfm
+    if 'Todos' not in filtro_segmentos and len(filtro_segmentos) > 0:
+        df_mostrar = df_rfm[df_rfm['Segmento'].isin(filtro_segmentos)]
 
-            # Aplicar filtro de productos
-            df_mostrar = df_perdidos.copy()
+    st.info(f"📊 Mostrando **{len(df_mostrar)}** de **{len(df_rfm)}** clientes")
+    tabla_paginada(df_mostrar, resultado['indice_busqueda'], key='tabla_rfm',
+                   etiqueta_busqueda="🔎 Buscar por nombre o código:")
 
-            if 'Todos' not in filtro_productos and len(filtro_productos) > 0:
-                # Extraer nombres de productos sin el contador
-                productos_seleccionados = [p.rsplit(' (', 1)[0] for p in filtro_productos]
+    # Descargas (con los segmentos seleccionados)
+    st.markdown("---")
+    st.subheader("💾 Descargar Segmentación")
+
+    # Los archivos se preparan al pulsar el botón: armar el Excel de cientos de miles de
+    # clientes en cada cambio de segmento bloquearía la página
+    clave_descarga = clave + (tuple(filtro_segmentos),)
+    if st.button("⚙️ Preparar descargas con los segmentos seleccionados", key='btn_preparar_descargas_rfm'):
+        excel, csv = archivos_rfm(df_mostrar, resumen)
+        st.session_state['descargas_rfm'] = {
+            'clave': clave_descarga,
+            'clientes': len(df_mostrar),
+            'excel': excel,
+            'csv': csv
+        }
 
-                # Filtrar DataFrame
-                mask = df_mostrar['Productos Comprados'].apply(
-                    lambda x: any(prod in x for prod in productos_seleccionados)
-                )
-                df_mostrar = df_mostrar[mask]
-
-            # Mostrar información de filtrado
-            if len(df_mostrar) < len(df_perdidos):
-                st.info(f"📊 Mostrando **{len(df_mostrar)}** de **{len(df_perdidos)}** clientes")
-            else:
-                st.info(f"📊 Mostrando **{len(df_perdidos)}** clientes")
-
-            # Mostrar tabla
-            st.dataframe(df_mostrar, use_container_width=True)
-
-            # Botón de descarga
-            st.markdown("---")
-            st.subheader("💾 Descargar Listado")
-
-            col1, col2 = st.columns(2)
-
-            with col1:
-                # Excel (con datos filtrados)
-                output = io.BytesIO()
-                with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                    df_mostrar.to_excel(writer, sheet_name='Clientes No Regresaron', index=False)
-                output.seek(0)
-                st.download_button(
-                    label=f"📥 Descargar Excel ({len(df_mostrar)} clientes)",
-                    data=output,
-                    file_name=f"clientes_no_regresaron_{año_actual}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+    descargas = st.session_state.get('descargas_rfm')
+    if descargas is not None and descargas['clave'][:-1] != clave:
+        # Archivos de un análisis anterior
+        del st.session_state['descargas_rfm']
+        descargas = None
+    if descargas is None:
+        return
+    if descargas['clave'] != clave_descarga:
+        st.warning("⚠️ La selección de segmentos cambió desde que se prepararon las descargas. Vuelve a prepararlas.")
+        return
 
-            with col2:
-                # CSV (con datos filtrados)
-                csv = df_mostrar.to_csv(index=False, encoding='utf-8-sig')
-                st.download_button(
-                    label=f"📥 Descargar CSV ({len(df_mostrar)} clientes)",
-                    data=csv,
-                    file_name=f"clientes_no_regresaron_{año_actual}.csv",
-                    mime="text/csv"
-                )
+    col1, col2 = st.columns(2)
 
-            st.success(f"✅ Análisis completado: {len(clientes_no_regresaron)} clientes no han regresado en {año_actual}")
-        else:
-            st.success("🎉 Excelente! Todos los clientes anteriores han regresado en el año actual.")
+    with col1:
+        st.download_button(
+            label=f"📥 Descargar Excel ({descargas['clientes']} clientes)",
+            data=descargas['excel'],
+            file_name=f"segmentacion_rfm_{resultado['año_actual']}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+
+    with col2:
+        st.download_button(
+            label=f"📥 Descargar CSV ({descargas['clientes']} clientes)",
+            data=descargas['csv'],
+            file_name=f"segmentacion_rfm_{resultado['año_actual']}.csv",
+            mime="text/csv"
+        )
+
+def archivos_rfm(df_mostrar, resumen):
+    """Excel (resumen y clientes) y CSV de clientes de la segmentación RFM"""
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        resumen.to_excel(writer, sheet_name='Resumen por Segmento', index=False)
+        df_mostrar.to_excel(writer, sheet_name='Clientes', index=False)
+    csv = df_mostrar.to_csv(index=False, encoding='utf-8-sig')
+    return output.getvalue(), csv
 
 
 # ============================================
@@ -808,7 +2234,7 @@ with st.sidebar:
 
     opcion = st.radio(
         "Selecciona una función:",
-        ["📈 Análisis de Recompra", "🔄 Fidelización de Clientes"],
+        ["📈 Análisis de Recompra", "🔄 Fidelización de Clientes", "🎯 Segmentación RFM"],
         key='menu_principal'
     )
 
@@ -823,7 +2249,7 @@ with st.sidebar:
         2. **Haz clic en Analizar.** El aplicativo te mostrará los estadísticos de total de clientes y recompra de los **3 años anteriores**.
         3. **Descarga** las gráficas y el Excel con la información para armar otros informes.
         """)
-    else:  # Fidelización de Clientes
+    elif opcion == "🔄 Fidelización de Clientes":
         st.markdown("""
         1. **Selecciona los filtros** que deseas aplicar (igual que en Análisis de Recompra).
         2. **Haz clic en Analizar Fidelización** para identificar clientes que no han regresado en el año actual.
@@ -833,6 +2259,17 @@ with st.sidebar:
            - Comparación general de fidelización
         4. Podrás **descargar un listado completo** con datos de contacto de clientes que no han regresado.
         """)
+    else:  # Segmentación RFM
+        st.markdown("""
+        1. **Selecciona los filtros** que deseas aplicar (igual que en Análisis de Recompra).
+        2. **Haz clic en Segmentar Clientes.** Cada cliente recibe puntajes de 1 a 5 de:
+           - **R**ecencia: qué tan reciente fue su última compra
+           - **F**recuencia: cuántas visitas ha hecho
+           - **A**mplitud: cuántos productos distintos ha comprado
+        3. Verás cuántos clientes hay en cada **segmento** (Campeones, En riesgo, Hibernando, etc.),
+           asignado según R y F.
+        4. Podrás **filtrar por segmento** y **descargar** el listado con datos de contacto.
+        """)
 
     st.markdown("---")
     st.markdown("💡 **Tip:** Puedes cambiar de función en cualquier momento usando el menú superior")
@@ -840,6 +2277,7 @@ with st.sidebar:
     # Botón para recargar datos
     if st.button("🔄 Actualizar Datos"):
         st.cache_data.clear()
+        cargar_datos_desde_drive.clear()
         st.rerun()
 
 # Cargar datos
@@ -874,7 +2312,7 @@ st.markdown(
 )
 año_actual = st.selectbox(
     "Selecciona el año de referencia:",
-    options=list(range(datetime.now().year, datetime.now().year - 6, -1)),
+    options=años_de_referencia(),
     index=0,
     key='año_referencia'
 )
@@ -884,5 +2322,7 @@ st.markdown("---")
 # EJECUTAR LA FUNCIÓN SELECCIONADA
 if opcion == "📈 Análisis de Recompra":
     analisis_recompra(df, año_actual)
-else:  # Fidelización de Clientes
+elif opcion == "🔄 Fidelización de Clientes":
     fidelizacion_clientes(df, año_actual)
+else:  # Segmentación RFM
+    segmentacion_rfm(df, año_actual)
@@ -0,0 +1,284 @@
+"""
+Prueba de carga del aplicativo: simula N sesiones simultáneas con AppTest de Streamlit
+sobre un conjunto de datos sintético local, y reporta latencias (p50/p95) y memoria
+pico (RSS) para cada cantidad de sesiones.
+
+Uso:
+    python prueba_carga.py --sesiones 1,2,4,8 --filas 200000
+
+Cada cantidad de sesiones se mide en un proceso aparte, para que la memoria pico
+de un nivel no contamine al siguiente.
+
+Limitación: AppTest no permite ejecutar el script de varias sesiones a la vez en un mismo
+proceso, así que las ejecuciones se serializan con un candado (ver preparar_apptest) y solo
+los análisis en segundo plano corren en paralelo. La espera por ese candado, que un servidor
+real no tiene, se mide aparte: las latencias p50/p95 la descuentan y la cola se reporta en
+sus propias columnas. La memoria es la del proceso completo (intérprete, datos compartidos
+y sesiones).
+"""
+import argparse
+import io
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+RUTA_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+# Tiempo máximo de espera de un análisis en segundo plano (segundos)
+ESPERA_MAXIMA = 300
+# Intervalo entre consultas mientras un análisis está en curso (segundos)
+INTERVALO_CONSULTA = 0.1
+
+# Segundos que cada hilo (sesión) lleva esperando el candado de AppTest (ver preparar_apptest)
+ESPERA_CANDADO = threading.local()
+
+def espera_acumulada():
+    """Espera total por el candado de AppTest del hilo actual"""
+    return getattr(ESPERA_CANDADO, 'segundos', 0.0)
+
+def generar_datos(ruta, filas, semilla=0, fraccion_compra_unica=0.0):
+    """
+    Genera un CSV sintético con la misma disposición de columnas que el archivo real:
+    el aplicativo lee las columnas por posición (fecha en C, cliente en D, etc.).
+    `fraccion_compra_unica` es la fracción de filas que son clientes de una sola visita.
+    """
+    rng = np.random.default_rng(semilla)
+    clientes = rng.integers(0, max(filas // 5, 1), filas)
+    unicas = rng.random(filas) < fraccion_compra_unica
+    clientes[unicas] = max(filas // 5, 1) + np.arange(np.count_nonzero(unicas))
+    fechas = pd.Timestamp(f'{pd.Timestamp.now().year - 7}-01-01') + pd.to_timedelta(
+        rng.integers(0, 365 * 8, filas), unit='D'
+    )
+
+    columnas = {f'Columna {i}': [''] * filas for i in range(23)}
+    df = pd.DataFrame(columnas)
+    df['Columna 0'] = np.arange(filas)  # Factura
+    df['Columna 2'] = fechas.strftime('%d/%m/%Y')  # C: Fecha
+    df['Columna 3'] = clientes  # D: Código de cliente
+    df['Columna 4'] = [f'Cliente {c}' for c in clientes]  # E: Nombre
+    df['Columna 5'] = [f'cliente{c}@correo.com' for c in clientes]  # F: Correo
+    df['Columna 6'] = 3000000000 + clientes  # G: Teléfono 1
+    df['Columna 8'] = [f'PLC{c % 9000:04d}' for c in clientes]  # I: Placa
+    df['Columna 11'] = rng.choice(['Asesor interno', 'Asesor externo', 'Call center'], filas)  # L
+    df['Columna 13'] = rng.choice(['Bogotá', 'Medellín', 'Cali', 'Barranquilla', 'Bucaramanga'], filas)  # N
+    df['Columna 16'] = rng.choice(['Llanta 175/70', 'Llanta 195/65', 'Aceite 20W50', 'Pastillas', 'Batería'], filas)  # Q
+    df['Columna 18'] = rng.choice(['Llantas', 'Lubricantes', 'Frenos', 'Baterías'], filas)  # S
+    df['Columna 22'] = rng.choice(['Norte', 'Sur', 'Centro'], filas)  # W
+    df.to_csv(ruta, index=False)
+
+def esperar_resultados(at):
+    """Vuelve a ejecutar el script hasta que no quede ningún análisis en curso"""
+    limite = time.perf_counter() + ESPERA_MAXIMA
+    while at.get('progress') and time.perf_counter() < limite:
+        time.sleep(INTERVALO_CONSULTA)
+        at.run()
+
+def medir(latencias, accion, at):
+    """
+    Ejecuta una interacción, espera sus resultados y registra cuánto tardó, como el par
+    (latencia sin la espera por el candado de AppTest, espera por el candado)
+    """
+    espera_inicial = espera_acumulada()
+    inicio = time.perf_counter()
+    accion()
+    esperar_resultados(at)
+    espera = espera_acumulada() - espera_inicial
+    latencias.append((time.perf_counter() - inicio - espera, espera))
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+
+def preparar_apptest():
+    """
+    Ajusta AppTest para varias sesiones en un mismo proceso, reemplazando métodos internos
+    (privados) de Streamlit; puede requerir cambios al actualizar Streamlit.
+    AppTest instala un Runtime simulado global en cada ejecución, así que las ejecuciones
+    del script se serializan con un candado; los análisis en segundo plano sí corren en
+    paralelo en el pool del aplicativo. El tiempo que cada hilo espera el candado se
+    acumula en ESPERA_CANDADO, para descontarlo de las latencias.
+    Además, AppTest recompila app.py en cada ejecución con un ScriptCache nuevo; el
+    servidor real comparte uno solo entre sesiones, así que aquí se hace lo mismo.
+    """
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1.app_test import AppTest
+
+    compartido = ScriptCache()
+    obtener_original = ScriptCache.get_bytecode
+    ScriptCache.get_bytecode = lambda self, ruta: obtener_original(compartido, ruta)
+
+    candado = threading.Lock()
+    ejecutar_original = AppTest._run
+
+    def ejecutar(self, *args, **kwargs):
+        inicio = time.perf_counter()
+        with candado:
+            ESPERA_CANDADO.segundos = espera_acumulada() + time.perf_counter() - inicio
+            return ejecutar_original(self, *args, **kwargs)
+
+    AppTest._run = ejecutar
+
+def sesion(numero, barrera, latencias, errores):
+    """Una sesión simulada: filtros, análisis de recompra y de fidelización, filtro y búsqueda"""
+    from streamlit.testing.v1 import AppTest
+
+    azar = random.Random(numero)
+    try:
+        at = AppTest.from_file(RUTA_APP, default_timeout=ESPERA_MAXIMA)
+        barrera.wait()
+
+        medir(latencias, at.run, at)
+
+        # Análisis de recompra con un subconjunto de CDS
+        cds = at.multiselect(key='depto').options[1:]
+        seleccion = azar.sample(cds, k=azar.randint(1, len(cds)))
+        medir(latencias, lambda: at.multiselect(key='depto').set_value(seleccion).run(), at)
+        medir(latencias, lambda: at.button(key='btn_analizar_recompra').click().run(), at)
+
+        # Cambiar el año de referencia y volver a analizar
+        años = at.selectbox(key='año_referencia').options
+        medir(latencias, lambda: at.selectbox(key='año_referencia').set_value(int(años[1])).run(), at)
+        medir(latencias, lambda: at.button(key='btn_analizar_recompra').click().run(), at)
+
+        # Fidelización, filtro de productos y búsqueda en el listado
+        medir(latencias, lambda: at.radio(key='menu_principal').set_value("🔄 Fidelización de Clientes").run(), at)
+        medir(latencias, lambda: at.button(key='btn_fidelizacion').click().run(), at)
+        if any(widget.key == 'filtro_productos' for widget in at.multiselect):
+            productos = at.multiselect(key='filtro_productos').options[1:]
+            if productos:
+                medir(latencias, lambda: at.multiselect(key='filtro_productos').set_value([azar.choice(productos)]).run(), at)
+        if any(widget.key == 'tabla_perdidos_busqueda' for widget in at.text_input):
+            medir(latencias, lambda: at.text_input(key='tabla_perdidos_busqueda').input(f'cliente {azar.randint(1, 99)}').run(), at)
+    except Exception as e:
+        errores.append(f"Sesión {numero}: {e}")
+
+def verificar_rfm(carpeta):
+    """
+    Verifica la segmentación RFM con una base donde la mayoría de los clientes compra una
+    sola vez: todo cliente de 1 visita debe tener F = 1 y "Nuevos" no puede quedar vacío.
+    """
+    from streamlit.testing.v1 import AppTest
+
+    ruta_datos = os.path.join(carpeta, 'datos_compra_unica.csv')
+    generar_datos(ruta_datos, 20000, fraccion_compra_unica=0.6)
+    os.environ['TLL_DATOS_LOCAL'] = ruta_datos
+    os.environ['TLL_ALMACEN_RESULTADOS'] = os.path.join(carpeta, 'resultados_rfm.sqlite')
+
+    at = AppTest.from_file(RUTA_APP, default_timeout=ESPERA_MAXIMA)
+    at.run()
+    at.radio(key='menu_principal').set_value("🎯 Segmentación RFM").run()
+    at.button(key='btn_rfm').click().run()
+    esperar_resultados(at)
+    at.button(key='btn_preparar_descargas_rfm').click().run()
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+
+    df_rfm = pd.read_csv(io.StringIO(at.session_state['descargas_rfm']['csv'].lstrip('\ufeff')))
+    una_visita = df_rfm['Visitas'] == 1
+    segmentos = df_rfm['Segmento'].value_counts()
+    print(f"Clientes: {len(df_rfm)}, de una sola visita: {una_visita.mean():.0%}")
+    print(segmentos.to_string())
+
+    errores = []
+    if (df_rfm.loc[una_visita, 'F'] != 1).any():
+        errores.append("Hay clientes de una sola visita con F distinto de 1")
+    if segmentos.get('Nuevos', 0) == 0:
+        errores.append('El segmento "Nuevos" quedó vacío')
+    for error in errores:
+        print(f"ERROR: {error}", file=sys.stderr)
+    print("Verificación RFM: " + ("falló" if errores else "correcta"))
+    return not errores
+
+def rss_pico_mb():
+    """Memoria residente pico del proceso (ru_maxrss está en KB en Linux y en bytes en macOS)"""
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico / (1024 * 1024) if sys.platform == 'darwin' else pico / 1024
+
+def ejecutar_nivel(sesiones):
+    """Corre `sesiones` sesiones simultáneas en este proceso e imprime una línea de resultados"""
+    preparar_apptest()
+    barrera = threading.Barrier(sesiones)
+    latencias = []
+    errores = []
+    hilos = [
+        threading.Thread(target=sesion, args=(numero, barrera, latencias, errores))
+        for numero in range(sesiones)
+    ]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    for error in errores:
+        print(error, file=sys.stderr)
+    if latencias:
+        p50, p95 = np.percentile([latencia for latencia, _ in latencias], [50, 95])
+        cola_p50, cola_p95 = np.percentile([espera for _, espera in latencias], [50, 95])
+    else:
+        p50 = p95 = cola_p50 = cola_p95 = float('nan')
+    print(f"RESULTADO {sesiones} {len(latencias)} {p50:.3f} {p95:.3f} {cola_p50:.3f} {cola_p95:.3f} "
+          f"{rss_pico_mb():.1f} {len(errores)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga con sesiones simultáneas de AppTest")
+    parser.add_argument('--sesiones', default='1,2,4,8',
+                        help="Cantidades de sesiones simultáneas a medir, separadas por comas")
+    parser.add_argument('--filas', type=int, default=200000, help="Filas del conjunto de datos sintético")
+    parser.add_argument('--datos', help="CSV local a usar en lugar de generar uno sintético")
+    parser.add_argument('--verificar-rfm', action='store_true',
+                        help="Solo verifica la segmentación RFM con una base de clientes de una sola visita")
+    parser.add_argument('--nivel', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Proceso hijo: mide una sola cantidad de sesiones
+    if args.nivel is not None:
+        ejecutar_nivel(args.nivel)
+        return
+
+    carpeta = tempfile.mkdtemp(prefix='tll_prueba_carga_')
+    try:
+        if args.verificar_rfm:
+            if not verificar_rfm(carpeta):
+                sys.exit(1)
+            return
+        medir_niveles(args, carpeta)
+    finally:
+        # Datos sintéticos y almacenes de resultados de la prueba
+        shutil.rmtree(carpeta, ignore_errors=True)
+
+def medir_niveles(args, carpeta):
+    """Mide cada cantidad de sesiones pedida en un proceso hijo e imprime la tabla de resultados"""
+    ruta_datos = args.datos
+    if ruta_datos is None:
+        ruta_datos = os.path.join(carpeta, 'datos_sinteticos.csv')
+        print(f"Generando {args.filas} filas sintéticas en {ruta_datos}...")
+        generar_datos(ruta_datos, args.filas)
+
+    print(f"{'Sesiones':>8} {'Interacciones':>13} {'p50 (s)':>8} {'p95 (s)':>8} "
+          f"{'Cola p50 (s)':>12} {'Cola p95 (s)':>12} {'RSS pico proceso (MB)':>22} {'Errores':>8}")
+    for sesiones in [int(valor) for valor in args.sesiones.split(',')]:
+        entorno = dict(os.environ)
+        entorno['TLL_DATOS_LOCAL'] = ruta_datos
+        # Almacén de resultados vacío por nivel: se mide el cálculo, no lecturas de niveles anteriores
+        entorno['TLL_ALMACEN_RESULTADOS'] = os.path.join(carpeta, f'resultados_{sesiones}.sqlite')
+        proceso = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--nivel', str(sesiones)],
+            env=entorno, capture_output=True, text=True
+        )
+        lineas = [linea for linea in proceso.stdout.splitlines() if linea.startswith('RESULTADO ')]
+        if proceso.returncode != 0 or not lineas:
+            print(f"{sesiones:>8} falló:\n{proceso.stderr[-2000:]}")
+            continue
+        _, _, interacciones, p50, p95, cola_p50, cola_p95, rss, errores = lineas[-1].split()
+        print(f"{sesiones:>8} {interacciones:>13} {float(p50):>8.3f} {float(p95):>8.3f} "
+              f"{float(cola_p50):>12.3f} {float(cola_p95):>12.3f} {float(rss):>22.1f} {errores:>8}")
+
+if __name__ == '__main__':
+    main()